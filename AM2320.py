@@ -1,9 +1,15 @@
-from logger import setup_logger
-from os import open, close, write, read, O_RDWR
-from fcntl import ioctl  # type: ignore
-from time import sleep
-from logging import Logger
+from logger import level_matcher
+from random import uniform
+from time import monotonic, sleep
+from logging import Logger, getLogger
 from bases.AM2320Base import AM2320Base
+from bases.I2CBusBase import I2CBusBase
+from i2c import LinuxI2CBus
+from crc import crc16
+from metrics import REGISTRY
+from tracing import PhaseTimer, TraceBuilder
+
+CRC_ERRORS = REGISTRY.counter("am2320_crc_errors_total", "Frames received with a bad CRC", ["bus"])
 
 
 def usleep(microseconds: int):
@@ -16,88 +22,119 @@ class AM2320(AM2320Base):
     IOCTL_CMD: int = 0x0703
     read_count: int = 2
     err_count: int = 0
-    fd: int
-    log: Logger = setup_logger("WARN")
+    i2c: I2CBusBase
+    log: Logger = getLogger(__name__)
     delay: int = 2
-
-    def __init__(self, addr: int = None, bus: str = None, read_count: int = None, loglevel: str = None):
-        super().__init__(addr, bus, read_count, loglevel)
-        if loglevel:
-            self.log = setup_logger(loglevel)
+    # CRC retries per `_read_registers` call: at most `max_retries`, and none that would
+    # start after `retry_budget` seconds. Backoff before retry n is uniform(0, retry_backoff * 2^n)
+    max_retries: int = 5
+    retry_budget: float = 1.0
+    retry_backoff: float = 0.01
+    # microseconds to wait after the wakeup and after the read request, the datasheet
+    # values unless calibrated (see calibration.py)
+    wakeup_delay: int = 850
+    settle_delay: int = 1800
+
+    def __init__(self, addr: int = None, bus: str = None, read_count: int = None, loglevel: str = None,
+                 i2c: I2CBusBase = None):
+        super().__init__(addr, bus, read_count, loglevel, i2c)
         if read_count:
             self.read_count = read_count
         if addr:
             self.I2C_ADDR = addr
         if bus:
             self.I2C_BUS = bus
+        if loglevel:
+            # a logger per bus, so the level and the rate limit (see logger.py) are per sensor
+            self.log = getLogger(f"{__name__}.{self.I2C_BUS}")
+            self.log.setLevel(level_matcher(loglevel))
 
-        self.log.debug(f"Opening bus '{self.I2C_BUS}'")
-        self.fd = open(self.I2C_BUS, O_RDWR)
-        self.log.debug(f"calling ioctl() with command '{hex(self.IOCTL_CMD)}' "
-                       f"on I2C address '{hex(self.I2C_ADDR)}'")
-        ioctl(self.fd, self.IOCTL_CMD, self.I2C_ADDR)
+        # the real bus unless something else (e.g. simulator.SimulatedAM2320Bus) is given
+        self.i2c = i2c or LinuxI2CBus(self.I2C_BUS, self.I2C_ADDR, self.IOCTL_CMD)
+        self.i2c.open()
 
     def __enter__(self):  # idk what's the point of this tbh
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):  # is this even necessary?
-        if self.fd:
-            close(self.fd)
-        print(exc_type, exc_val, exc_tb)
+        self.i2c.close()
 
     def _send(self, b: bytes):
         self.log.debug(f"SENSOR_SEND: {b.hex()}")
-        return write(self.fd, b)
+        return self.i2c.write(b)
 
     def _recv(self, length: int = 8):
-        return read(self.fd, length)
+        return self.i2c.read(length)
 
-    def _wakeup(self):
+    def _wakeup(self, timer: PhaseTimer = None):
         try:
             # will raise OSError every time if the device is asleep
             self._send(b'\xff')
         except OSError:
             pass
-        usleep(850)
+        if timer:
+            timer.lap("wakeup")
+        usleep(self.wakeup_delay)
+        if timer:
+            timer.lap("wakeup_sleep")
 
     def _read_registers(self, start: int, num: int):
         arr = bytearray([0x03, start, num])
         # device always sends [0x03, <num_regs_asked>, <reg_data>, crc_hi, crc_lo]
         size = num + 4
-
-        self.log.debug(f"Sensor wakeup")
-        self._wakeup()
-
-        self.log.info(f"Request the data...")
-        self._send(bytes(arr))
-        usleep(1800)
-
-        self.log.info(f"...read the data")
-        data = self._recv(size)
-        self.log.debug(f"SENSOR_RECV: {data.hex(' ', 2)}")
-
-        self.log.info(f"Verifying data...")
-        crc = self._crc16(data[0:size - 2])
-        self.log.debug(f"CRC: {crc}")
-
-        dev_crc = data[size - 1] << 8 | data[size - 2]
-        self.log.debug(f"SENSOR_CRC: {dev_crc}")
-
-        if self.err_count > 5:
-            # to prevent recursion loop
-            self.log.critical(
-                f"Refusing to continue after 5 consecutive CRC Errors")
-            raise IOError
-        if crc != dev_crc:
-            self.err_count += 1
-            self.log.error(
-                f"Received CRC error, re-reading (error count: {self.err_count}")
-            self._read_registers(start, num)
-        else:
-            self.log.info(f"Read OK")
-            print()
-            self.err_count = 0
-            return data
+        trace = TraceBuilder(self.i2c.path, start, num)
+        deadline = monotonic() + self.retry_budget
+        error: str | None = "crc"
+        try:
+            for attempt in range(self.max_retries + 1):
+                timer = PhaseTimer()
+
+                self.log.debug(f"Sensor wakeup")
+                self._wakeup(timer)
+
+                self.log.info(f"Request the data...")
+                self._send(bytes(arr))
+                timer.lap("request")
+                usleep(self.settle_delay)
+                timer.lap("request_sleep")
+
+                self.log.info(f"...read the data")
+                data = self._recv(size)
+                timer.lap("read")
+                self.log.debug(f"SENSOR_RECV: {data.hex(' ', 2)}")
+
+                self.log.info(f"Verifying data...")
+                crc = self._crc16(data[0:size - 2])
+                self.log.debug(f"CRC: {crc}")
+
+                dev_crc = data[size - 1] << 8 | data[size - 2]
+                self.log.debug(f"SENSOR_CRC: {dev_crc}")
+                timer.lap("crc")
+                trace.attempts.append(timer.attempt(crc == dev_crc))
+
+                if crc == dev_crc:
+                    self.log.info(f"Read OK")
+                    self.err_count = 0
+                    error = None
+                    return data
+
+                CRC_ERRORS.labels(self.i2c.path).inc()
+                self.err_count = attempt + 1
+                # full jitter, so drivers retrying on the same noisy bus spread out
+                backoff = uniform(0, self.retry_backoff * 2 ** attempt)
+                if attempt == self.max_retries or monotonic() + backoff > deadline:
+                    break
+                self.log.error(f"Received CRC error, re-reading in {backoff * 1000:.0f} ms "
+                               f"(error count: {self.err_count})")
+                sleep(backoff)
+        except OSError as e:
+            error = repr(e)
+            raise
+        finally:
+            if self.trace_hooks:
+                self._emit_trace(trace.build(error))
+        self.log.critical(f"Refusing to continue after {self.err_count} consecutive CRC errors")
+        raise IOError(f"CRC errors on {self.err_count} consecutive reads")
 
     def get_humidity(self):
         val = b'\x00'
@@ -128,15 +165,6 @@ class AM2320(AM2320Base):
 
     @staticmethod
     def _crc16(data: bytes):
-        # Theoretically, according to the internet, array comparison from lookup table is
-        # faster than iterating over the values this way. This looks cleaner and the speed benefit is marginal
-        crc = 0xFFFF
-        for i in data:
-            crc = crc ^ i
-            for bit in range(8):
-                if crc & 0x0001:
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
-        return crc
+        # table driven, see crc.py. The bit-by-bit version is kept there as crc16_bitwise
+        # for reference, benchmarks/bench_crc16.py compares the two.
+        return crc16(data)
@@ -0,0 +1,196 @@
+from asyncio import Future, Lock, ensure_future, get_running_loop, shield, sleep
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger, getLogger
+from random import uniform
+from time import monotonic
+from typing import Awaitable, Callable, Dict, NamedTuple
+from bases.AM2320Base import AM2320Base
+from metrics import REGISTRY
+from tracing import PhaseTimer, TraceBuilder
+
+BUS_WAIT = REGISTRY.histogram("am2320_bus_wait_seconds", "Time spent waiting for the bus lock", ["bus"])
+TRANSACTION = REGISTRY.histogram("am2320_transaction_seconds",
+                                 "Duration of a wakeup/request/read cycle including CRC retries", ["bus"])
+CRC_ERRORS = REGISTRY.counter("am2320_crc_errors_total", "Frames received with a bad CRC", ["bus"])
+READ_FAILURES = REGISTRY.counter("am2320_read_failures_total", "Reads that failed with bus or CRC errors", ["bus"])
+
+
+class Reading(NamedTuple):
+    frame: bytes
+    crc_retries: int
+
+
+class AsyncAM2320:
+    """
+    asyncio front-end for an `AM2320` driver.
+
+    Bus I/O (`_send`/`_recv` of the wrapped driver) runs on a single dedicated worker
+    thread, every wait is an `asyncio.sleep` and one wakeup/request/read cycle holds the
+    bus lock. Read parameters are passed per call instead of being set on the instance.
+    Concurrent callers asking for the same thing share one in-flight bus transaction.
+
+    With `fast_read` a read while the sensor is known to be awake (last bus transaction
+    less than `awake_window` seconds ago, the sensor sleeps after 3 s) is a single bus
+    transaction: the measurement it returns was taken at the end of that last
+    transaction, so the extra reads and the waits between them buy nothing.
+    """
+    max_retries: int = 5
+    retry_budget: float = 1.0
+    retry_backoff: float = 0.01
+    fast_read: bool = False
+    awake_window: float = 2.5
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, dev: AM2320Base, executor: ThreadPoolExecutor = None, lock: Lock = None,
+                 max_retries: int = None, fast_read: bool = None):
+        """
+        :param dev: the synchronous driver doing the actual bus I/O
+        :param executor: worker to run bus I/O on, share it between drivers on the same bus
+        :param lock: bus lock, share it between drivers on the same bus
+        :param max_retries: how many times at most to re-read on CRC errors before giving up
+        :param fast_read: do a single read when the sensor is awake
+        """
+        self.dev = dev
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="i2c")
+        self.lock = lock or Lock()
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if fast_read is not None:
+            self.fast_read = fast_read
+        self._last_activity = float("-inf")
+        self._inflight: Dict[tuple, Future] = {}
+        bus = self._bus = str(dev.i2c.path)
+        self._bus_wait = BUS_WAIT.labels(bus)
+        self._transaction_time = TRANSACTION.labels(bus)
+        self._crc_errors = CRC_ERRORS.labels(bus)
+        self._read_failures = READ_FAILURES.labels(bus)
+
+    async def _call(self, fn: Callable, *args):
+        return await get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _wakeup_sync(self) -> None:
+        try:
+            # will raise OSError every time if the device is asleep
+            self.dev._send(b'\xff')
+        except OSError:
+            pass
+
+    async def _wakeup(self, timer: PhaseTimer) -> None:
+        await self._call(self._wakeup_sync)
+        timer.lap("wakeup")
+        await sleep(self.dev.wakeup_delay / 1000000)
+        timer.lap("wakeup_sleep")
+
+    async def _transaction(self, start: int, num: int) -> Reading:
+        """
+        Same steps and retry budget as `AM2320._read_registers`, with the bus held for
+        the whole cycle.
+        """
+        size = num + 4
+        request = bytes([0x03, start, num])
+        trace = TraceBuilder(self._bus, start, num)
+        error: str | None = "cancelled"
+        retries = 0
+        async with self.lock:
+            trace.got_bus()
+            self._bus_wait.observe(trace.bus_wait)
+            deadline = monotonic() + self.retry_budget
+            try:
+                for retries in range(self.max_retries + 1):
+                    timer = PhaseTimer()
+                    await self._wakeup(timer)
+                    await self._call(self.dev._send, request)
+                    timer.lap("request")
+                    await sleep(self.dev.settle_delay / 1000000)
+                    timer.lap("request_sleep")
+                    data = await self._call(self.dev._recv, size)
+                    timer.lap("read")
+                    self._last_activity = monotonic()
+                    ok = len(data) == size and \
+                        self.dev._crc16(data[0:size - 2]) == (data[size - 1] << 8 | data[size - 2])
+                    timer.lap("crc")
+                    trace.attempts.append(timer.attempt(ok))
+                    if ok:
+                        error = None
+                        return Reading(bytes(data), retries)
+                    self._crc_errors.inc()
+                    backoff = uniform(0, self.retry_backoff * 2 ** retries)
+                    if retries == self.max_retries or monotonic() + backoff > deadline:
+                        break
+                    self.log.error(f"Received CRC error, re-reading in {backoff * 1000:.0f} ms "
+                                   f"(error count: {retries + 1})")
+                    await sleep(backoff)
+                error = "crc"
+            except OSError as e:
+                error = repr(e)
+                self._read_failures.inc()
+                raise
+            finally:
+                t = trace.build(error)
+                self._transaction_time.observe(t.total)
+                if self.dev.trace_hooks:
+                    self.dev._emit_trace(t)
+        self._read_failures.inc()
+        self.log.critical(f"Refusing to continue after {retries + 1} consecutive CRC errors")
+        raise IOError(f"CRC errors on {retries + 1} consecutive reads")
+
+    def _forget(self, key: tuple, fut: Future) -> None:
+        self._inflight.pop(key, None)
+        if not fut.cancelled():
+            # mark the exception retrieved, every waiter gets it from shield()
+            fut.exception()
+
+    async def _single_flight(self, key: tuple, factory: Callable[[], Awaitable]):
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = ensure_future(factory())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.log.debug(f"Joining in-flight read {key}")
+        # a cancelled caller must not cancel the read for everyone else
+        return await shield(fut)
+
+    async def read_registers(self, start: int, num: int) -> bytes:
+        reading = await self._single_flight(("regs", start, num), lambda: self._transaction(start, num))
+        return reading.frame
+
+    async def _read(self, start: int, num: int, read_count: int, delay: float) -> Reading:
+        reading = Reading(b'\x00', 0)
+        for i in range(read_count):
+            self.log.info(f"Begin read #{i + 1}")
+            reading = await self._transaction(start, num)
+            if i < read_count - 1:
+                await sleep(delay)
+        return reading
+
+    def awake(self) -> bool:
+        """
+        True if the sensor answered a read less than `awake_window` seconds ago
+        """
+        return monotonic() - self._last_activity < self.awake_window
+
+    async def read(self, start: int, num: int, read_count: int = None, delay: float = None) -> Reading:
+        """
+        Do `read_count` reads of `num` registers starting at `start`, `delay` seconds apart,
+        and return the last one. The first read after wakeup returns the previous measurement.
+        With `fast_read` and an awake sensor this is a single read.
+        :param read_count: defaults to the wrapped driver's `read_count`
+        :param delay: defaults to the wrapped driver's `delay`
+        """
+        count: int = 1 if self.fast_read and self.awake() else read_count or self.dev.read_count
+        wait: float = delay if delay else getattr(self.dev, "delay", 2)
+        key = ("read", start, num, count, wait)
+        return await self._single_flight(key, lambda: self._read(start, num, count, wait))
+
+    async def get_humidity(self, read_count: int = None, delay: float = None) -> bytes:
+        return (await self.read(0x00, 0x02, read_count, delay)).frame
+
+    async def get_temperature(self, read_count: int = None, delay: float = None) -> bytes:
+        return (await self.read(0x02, 0x02, read_count, delay)).frame
+
+    async def get_all(self, read_count: int = None, delay: float = None) -> bytes:
+        return (await self.read(0x00, 0x04, read_count, delay)).frame
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
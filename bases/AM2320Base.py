@@ -1,6 +1,9 @@
 from os import PathLike
 from abc import ABC
 from logging import Logger
+from typing import Callable, List
+from bases.I2CBusBase import I2CBusBase
+from tracing import ReadTrace
 
 
 class AM2320Base(ABC):
@@ -9,19 +12,46 @@ class AM2320Base(ABC):
     read_count: int
     err_count: int
     IOCTL_CMD: int
-    fd: int
+    i2c: I2CBusBase
     log: Logger
+    wakeup_delay: int               # µs after the wakeup byte
+    settle_delay: int               # µs between the request and reading the answer
+    trace_hooks: List[Callable[[ReadTrace], None]]
 
     def __init__(self,
                  addr: int = None,
                  bus: str = None,
                  read_count: int = None,
-                 loglevel: str = None):
-        pass
+                 loglevel: str = None,
+                 i2c: I2CBusBase = None):
+        """
+        :param i2c: bus to talk to the sensor through, defaults to the Linux I2C device `bus`
+        """
+        self.trace_hooks = []
 
     def __enter__(self):
         return self
 
+    def add_trace_hook(self, hook: Callable[[ReadTrace], None]) -> None:
+        """
+        Register a callable that receives a `tracing.ReadTrace` after every register read:
+        monotonic durations of each phase (wakeup write, 850 µs sleep, request write,
+        1800 µs sleep, read, CRC check) for every attempt, the bus wait and the retries.
+        Hooks may be called from the bus worker thread and must be quick.
+        :param hook: e.g. a `tracing.TraceRecorder`
+        """
+        self.trace_hooks.append(hook)
+
+    def remove_trace_hook(self, hook: Callable[[ReadTrace], None]) -> None:
+        self.trace_hooks.remove(hook)
+
+    def _emit_trace(self, trace: ReadTrace) -> None:
+        for hook in self.trace_hooks:
+            try:
+                hook(trace)
+            except Exception as e:
+                self.log.error(f"Trace hook {hook!r} failed: {e!r}")
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
@@ -53,15 +83,17 @@ class AM2320Base(ABC):
     def _read_registers(self, start: int, num: int) -> bytes:
         """
         This method does the following:
-            1. Sensor wakeup. (+ sleep 850 µs)
+            1. Sensor wakeup. (+ sleep `wakeup_delay`, 850 µs by the datasheet)
             2. Request `num` data, starting from `start` register.
-            3. Give the sensor 1800 µs time to "think"
+            3. Give the sensor `settle_delay` (1800 µs) time to "think"
             4. Read back the requested data
-            5. Verify the checksum of the data (CRC16)
+            5. Verify the checksum of the data (CRC16), on a mismatch back off and
+               start over from 1., within the retry budget of one call
             6. Return the data
         :param start: The register where to start reading from.
         :param num: How many registers to read
         :return: Received bytes from the sensor
+        :raises IOError: if the retry budget ran out on CRC errors
         """
         pass
 
@@ -0,0 +1,34 @@
+from abc import ABC
+
+
+class I2CBusBase(ABC):
+    path: str
+    addr: int
+
+    def open(self) -> None:
+        """
+        Open the bus and select the slave address. Called once by the driver.
+        :return: None
+        """
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def write(self, b: bytes) -> int:
+        """
+        Write bytes to the device
+        :param b: bytes to send
+        :return: number of bytes written
+        :raises OSError: if the device does not acknowledge (e.g. AM2320 while asleep)
+        """
+        pass
+
+    def read(self, length: int) -> bytes:
+        """
+        Read bytes from the device
+        :param length: how many bytes to read
+        :return: received bytes
+        :raises OSError: on bus errors
+        """
+        pass
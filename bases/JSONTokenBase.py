@@ -1,31 +1,35 @@
 from abc import ABC
-from jwcrypto.jws import JWS, JWK  # type: ignore
-from typing import Dict
+from typing import TYPE_CHECKING, Dict
+
+if TYPE_CHECKING:
+    from jwcrypto.jws import JWS, JWK  # type: ignore
 
 
 class JSONTokenBase(ABC):
-    __private_key: JWK
-    __public_key: JWK
-    token: JWS
+    __private_key: "JWK"
+    __public_key: "JWK"
+    token: "JWS"
 
-    def __load_key(self, path: str, passphrase: str = None) -> JWK:
+    def __load_key(self, path: str, passphrase: str = None) -> "JWK":
         pass
 
-    def __load_private_key(self, path: str, passphrase: str) -> JWK:
+    def __load_private_key(self, path: str, passphrase: str) -> "JWK":
         pass
 
-    def __load_public_key(self, path: str) -> JWK:
+    def __load_public_key(self, path: str) -> "JWK":
         pass
 
-    def sign(self, payload: Dict[str, str]) -> JWS:
+    def sign(self, payload: Dict[str, str]) -> "JWS":
         pass
 
     @staticmethod
-    def verify(token_string: str, public_key: JWK) -> None:
+    def verify(token_string: str, public_key: "JWK", cache=None) -> None:
         """
         verifies the token
         :param token_string:    raw jws token string
         :param public_key:      public key to verify the token against
+        :param cache:           (optional) cache of already verified tokens, skips
+                                signature verification on a hit
         :raises JWKeyNotFound
         :raises InvalidJWSSignature
         :raises InvalidJWSObject
@@ -0,0 +1,44 @@
+"""
+Compares the bitwise reference CRC16 against the table driven one.
+
+    python benchmarks/bench_crc16.py [number_of_frames]
+"""
+import sys
+from os import path, urandom
+from timeit import repeat
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from crc import crc16, crc16_bitwise, crc16_many  # noqa: E402
+
+
+def make_frames(n: int):
+    frames = []
+    for _ in range(n):
+        body = bytes([0x03, 0x04]) + urandom(4)
+        crc = crc16(body)
+        frames.append(body + bytes([crc & 0xff, crc >> 8]))
+    return frames
+
+
+def bench(label: str, fn, n: int):
+    best = min(repeat(fn, number=1, repeat=5))
+    print(f"{label:<28} {best * 1000:9.2f} ms  {best / n * 1e6:7.3f} us/frame")
+    return best
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frames = make_frames(n)
+    assert all(crc16(f[:6]) == crc16_bitwise(f[:6]) for f in frames[:1000])
+    assert all(crc16_many(frames))
+
+    print(f"{n} frames of 8 bytes")
+    ref = bench("bitwise (reference)", lambda: [crc16_bitwise(f[:6]) == (f[7] << 8 | f[6]) for f in frames], n)
+    tab = bench("table", lambda: [crc16(f[:6]) == (f[7] << 8 | f[6]) for f in frames], n)
+    many = bench("crc16_many", lambda: crc16_many(frames), n)
+    print(f"table speedup {ref / tab:.1f}x, crc16_many speedup {ref / many:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Runs the AM2320 drivers against the simulated sensor, no hardware needed.
+
+    python benchmarks/bench_driver.py [--latency S] [--crc-errors P] [--bus-errors P] [--reads N] [--clients N]
+
+Reports the time per get_all() for the blocking driver, and for the async driver
+with N concurrent callers (which share in-flight reads).
+"""
+import sys
+from argparse import ArgumentParser
+from asyncio import gather, run
+from os import path
+from statistics import mean, median
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from AM2320 import AM2320  # noqa: E402
+from AsyncAM2320 import AsyncAM2320  # noqa: E402
+from simulator import SimulatedAM2320Bus  # noqa: E402
+
+
+def report(label: str, times: list, bus: SimulatedAM2320Bus):
+    print(f"{label:<32} n={len(times):<4} mean {mean(times) * 1000:8.2f} ms  "
+          f"median {median(times) * 1000:8.2f} ms  max {max(times) * 1000:8.2f} ms  "
+          f"(bus writes {bus.writes}, reads {bus.reads})")
+
+
+def bench_sync(args) -> None:
+    bus = SimulatedAM2320Bus(latency=args.latency, crc_error_rate=args.crc_errors,
+                             bus_error_rate=args.bus_errors, seed=1)
+    dev = AM2320(i2c=bus, loglevel="WARN")
+    dev.delay = 0
+    times, failed = [], 0
+    for _ in range(args.reads):
+        t = perf_counter()
+        try:
+            if dev.get_all() is None:
+                failed += 1
+        except OSError:
+            dev.err_count = 0
+            failed += 1
+        times.append(perf_counter() - t)
+    report("AM2320.get_all", times, bus)
+    print(f"{'':<32} failed {failed}")
+
+
+async def bench_async(args) -> None:
+    bus = SimulatedAM2320Bus(latency=args.latency, crc_error_rate=args.crc_errors,
+                             bus_error_rate=args.bus_errors, seed=1)
+    dev = AsyncAM2320(AM2320(i2c=bus, loglevel="WARN"))
+    times, failed = [], 0
+
+    async def one():
+        nonlocal failed
+        t = perf_counter()
+        try:
+            await dev.get_all(delay=0.001)
+        except OSError:
+            failed += 1
+        times.append(perf_counter() - t)
+
+    for _ in range(args.reads):
+        await gather(*[one() for _ in range(args.clients)])
+    report(f"AsyncAM2320.get_all x{args.clients}", times, bus)
+    print(f"{'':<32} failed {failed}")
+    dev.close()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--crc-errors", type=float, default=0.0)
+    parser.add_argument("--bus-errors", type=float, default=0.0)
+    parser.add_argument("--reads", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=10)
+    args = parser.parse_args()
+    bench_sync(args)
+    run(bench_async(args))
+
+
+if __name__ == "__main__":
+    main()
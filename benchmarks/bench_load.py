@@ -0,0 +1,368 @@
+"""
+Load test of the HTTP API: concurrent clients replay a scenario against the app and the
+throughput and latency percentiles are reported per request type and stored as JSON.
+
+    python benchmarks/bench_load.py [--scenario mixed] [--clients 20] [--duration 30]
+                                    [--burst N --every S] [--url http://127.0.0.1:8000] [--out FILE]
+
+Without --url the app is driven in-process through ASGI (no sockets, no uvicorn), with the
+simulated sensor and throwaway databases. This needs the keys in keys/ and
+PRIVATE_KEY_PASSPHRASE (the environment or .env), SCRYPT_N etc. are honoured.
+With --url it runs against a uvicorn started separately, e.g. with SENSOR_BACKEND=sim, and
+--user/--password (and --login-user/--login-password for the authorize requests: a login
+revokes the user's previous token, so use a second user there).
+
+Scenarios:
+    authorize   POST /api/authorize only, the cost of the password hash and token signing
+    getData     GET /api/getData in every format, served from the sampler cache
+    fresh       GET /api/getData?max_age=0, every request waits for a sensor read
+    batch       POST /api/getData/batch with every format
+    mixed       dashboard traffic: mostly getData, some batch, stats, recent, a few logins
+With --burst N the clients do not loop, N requests are fired at once every --every seconds.
+"""
+import subprocess
+import sys
+from argparse import ArgumentParser
+from asyncio import Event, StreamReader, StreamWriter, gather, open_connection, run, sleep
+from base64 import b64encode
+from json import dumps, loads
+from math import ceil
+from os import chdir, environ, makedirs, path
+from random import Random
+from statistics import mean
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+from typing import Callable, Dict, List, NamedTuple, Tuple
+from urllib.parse import urlsplit
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+HOST = "logger.sokru.fi"
+# what nginx adds, SecurityMiddleware rejects requests without it
+PROXY_HEADERS = {"host": HOST, "x-nginx-proxy": "true", "x-real-ip": "127.0.0.1", "x-forwarded-for": "127.0.0.1"}
+FORMATS = ("json", "hex", "base64", "human")
+
+
+class Request(NamedTuple):
+    label: str
+    method: str
+    path: str
+    body: bytes = b""
+    auth: str = "bearer"     # "bearer", "basic" or "none"
+
+
+def _batch() -> bytes:
+    return dumps({"items": [{"q": q, "format": f} for q in ("all", "humi", "temp") for f in FORMATS]}).encode()
+
+
+SCENARIOS: Dict[str, List[Tuple[int, Request]]] = {
+    "authorize": [(1, Request("authorize", "POST", "/api/authorize", auth="basic"))],
+    "getData": [(1, Request(f"getData {f}", "GET", f"/api/getData?format={f}")) for f in FORMATS],
+    "fresh": [(1, Request("getData max_age=0", "GET", "/api/getData?max_age=0"))],
+    "batch": [(1, Request("batch", "POST", "/api/getData/batch", _batch()))],
+    "mixed": [(20, Request(f"getData {f}", "GET", f"/api/getData?format={f}")) for f in FORMATS] + [
+        (8, Request("batch", "POST", "/api/getData/batch", _batch())),
+        (5, Request("stats", "GET", "/api/stats")),
+        (5, Request("recent", "GET", "/api/recent?n=60")),
+        (1, Request("authorize", "POST", "/api/authorize", auth="basic"))],
+}
+
+
+def basic(username: str, password: str) -> str:
+    return "Basic " + b64encode(f"{username}:{password}".encode()).decode()
+
+
+class ASGIClient:
+    """
+    Calls the ASGI app directly, the whole middleware and routing stack runs but no socket
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, target: str, headers: Dict[str, str], body: bytes = b"") -> Tuple[int, bytes]:
+        url = urlsplit(target)
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+            "scheme": "http", "path": url.path, "raw_path": url.path.encode(), "query_string": url.query.encode(),
+            "root_path": "", "client": ("127.0.0.1", 50000), "server": (HOST, 80),
+            "headers": [(k.encode(), v.encode()) for k, v in headers.items()]
+                       + [(b"content-length", str(len(body)).encode())]
+        }
+        received = False
+        disconnected = Event()
+        status, chunks = 0, []
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            disconnected.set()
+        return status, b"".join(chunks)
+
+    async def close(self) -> None:
+        pass
+
+
+class HTTPClient:
+    """
+    Minimal HTTP/1.1 client on one keep-alive connection, enough for the JSON endpoints
+    """
+
+    def __init__(self, base_url: str):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.reader: StreamReader | None = None
+        self.writer: StreamWriter | None = None
+
+    async def _connection(self) -> Tuple[StreamReader, StreamWriter]:
+        if self.reader is None or self.writer is None:
+            self.reader, self.writer = await open_connection(self.host, self.port)
+        return self.reader, self.writer
+
+    async def request(self, method: str, target: str, headers: Dict[str, str], body: bytes = b"") -> Tuple[int, bytes]:
+        reader, writer = await self._connection()
+        head = f"{method} {target} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) \
+            + f"content-length: {len(body)}\r\n\r\n"
+        writer.write(head.encode() + body)
+        status_line = await reader.readline()
+        if not status_line:
+            await self.close()
+            raise ConnectionError("Connection closed by the server")
+        status = int(status_line.split()[1])
+        length, chunked, close = 0, False, False
+        while (line := await reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            name, value = name.strip().lower(), value.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "transfer-encoding" and "chunked" in value:
+                chunked = True
+            elif name == "connection" and value == "close":
+                close = True
+        if chunked:
+            data = b""
+            while size := int((await reader.readline()).split(b";")[0], 16):
+                data += await reader.readexactly(size + 2)
+                data = data[:-2]
+            await reader.readline()
+        else:
+            data = await reader.readexactly(length)
+        if close:
+            await self.close()
+        return status, data
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of an ascending list
+    """
+    return ordered[max(0, ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(results: List[Tuple[str, int, float]], elapsed: float) -> Dict[str, dict]:
+    by_label: Dict[str, List[Tuple[int, float]]] = {}
+    for label, status, seconds in results:
+        by_label.setdefault(label, []).append((status, seconds))
+    by_label["all"] = [(status, seconds) for _, status, seconds in results]
+    summary = {}
+    for label, rows in by_label.items():
+        latencies = sorted(s for _, s in rows)
+        statuses: Dict[str, int] = {}
+        for status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary[label] = {
+            "requests": len(rows),
+            "errors": sum(1 for status, _ in rows if status >= 400 or status == 0),
+            "statuses": statuses,
+            "throughput": len(rows) / elapsed,
+            "mean_ms": mean(latencies) * 1000,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000
+        }
+    return summary
+
+
+class LoadTest:
+    def __init__(self, scenario: str, make_client: Callable, credentials: Dict[str, str], seed: int = 1):
+        self.requests = SCENARIOS[scenario]
+        self.make_client = make_client
+        self.credentials = credentials
+        self.weights = [w for w, _ in self.requests]
+        self.rng = Random(seed)
+        self.token = ""
+        self.results: List[Tuple[str, int, float]] = []
+
+    def _headers(self, r: Request) -> Dict[str, str]:
+        headers = dict(PROXY_HEADERS)
+        if r.body:
+            headers["content-type"] = "application/json"
+        if r.auth == "bearer":
+            headers["authorization"] = f"Bearer {self.token}"
+        elif r.auth == "basic":
+            headers["authorization"] = self.credentials["login"]
+        return headers
+
+    async def login(self) -> None:
+        client = self.make_client()
+        headers = {**PROXY_HEADERS, "authorization": self.credentials["data"]}
+        status, body = await client.request("POST", "/api/authorize", headers)
+        await client.close()
+        if status != 200:
+            raise RuntimeError(f"Login failed: {status} {body[:200]!r}")
+        self.token = loads(body)["token"]
+
+    async def _one(self, client) -> None:
+        r = self.rng.choices(self.requests, self.weights)[0][1]
+        started = perf_counter()
+        try:
+            status, _ = await client.request(r.method, r.path, self._headers(r), r.body)
+        except (ConnectionError, OSError, ValueError):
+            status = 0
+        self.results.append((r.label, status, perf_counter() - started))
+
+    async def _loop(self, deadline: float) -> None:
+        client = self.make_client()
+        try:
+            while perf_counter() < deadline:
+                await self._one(client)
+        finally:
+            await client.close()
+
+    async def steady(self, clients: int, duration: float) -> float:
+        """
+        `clients` closed loops, each sends its next request when the previous one is answered
+        """
+        started = perf_counter()
+        await gather(*[self._loop(started + duration) for _ in range(clients)])
+        return perf_counter() - started
+
+    async def burst(self, size: int, every: float, duration: float) -> float:
+        """
+        `size` requests at once every `every` seconds, each on its own connection
+        """
+        pool = [self.make_client() for _ in range(size)]
+        started = perf_counter()
+        try:
+            while perf_counter() - started < duration:
+                wave = perf_counter()
+                await gather(*[self._one(c) for c in pool])
+                await sleep(max(0.0, every - (perf_counter() - wave)))
+        finally:
+            await gather(*[c.close() for c in pool])
+        return perf_counter() - started
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_in_process(args) -> Tuple[dict, float]:
+    with TemporaryDirectory() as tmp:
+        environ.update({
+            "SENSOR_BACKEND": "sim", "SENSORS_CONFIG": path.join(tmp, "sensors.json"),
+            "USERS_DB": path.join(tmp, "users.db"), "READINGS_DB": path.join(tmp, "readings.db"),
+            "CALIBRATION_FILE": path.join(tmp, "calibration.json"),
+            "DEMO_USER": "bench", "DEMO_PASSWORD": "bench", "LOG_LEVEL": environ.get("LOG_LEVEL", "WARN")
+        })
+        chdir(ROOT)     # keys/ is relative
+        import main
+        from crypto import hash_password
+        from sqlite import add_demo_user
+        app = main.app      # built on import, with the environment above
+        services = app.state.services
+        await app.router.startup()
+        try:
+            await gather(*[s.refresh() for s in services.sensors.samplers])
+            add_demo_user(services.users, "bench-login",
+                          hash_password("bench", *(services.credentials.cost or services.DEFAULT_COST)))
+            test = LoadTest(args.scenario, lambda: ASGIClient(app),
+                            {"data": basic("bench", "bench"), "login": basic("bench-login", "bench")}, args.seed)
+            return await _drive(test, args)
+        finally:
+            await app.router.shutdown()
+
+
+async def run_against(args) -> Tuple[dict, float]:
+    login = basic(args.login_user or args.user, args.login_password or args.password)
+    test = LoadTest(args.scenario, lambda: HTTPClient(args.url),
+                    {"data": basic(args.user, args.password), "login": login}, args.seed)
+    return await _drive(test, args)
+
+
+async def _drive(test: LoadTest, args) -> Tuple[dict, float]:
+    await test.login()
+    if args.burst:
+        elapsed = await test.burst(args.burst, args.every, args.duration)
+    else:
+        elapsed = await test.steady(args.clients, args.duration)
+    return summarize(test.results, elapsed), elapsed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--scenario", choices=list(SCENARIOS), default="mixed")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--burst", type=int, default=0, help="requests per wave instead of steady clients")
+    parser.add_argument("--every", type=float, default=1, help="seconds between waves")
+    parser.add_argument("--url", help="a running server instead of the in-process app")
+    parser.add_argument("--user", default="demo")
+    parser.add_argument("--password", default=environ.get("DEMO_PASSWORD", ""))
+    parser.add_argument("--login-user")
+    parser.add_argument("--login-password")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="JSON results file, benchmarks/results/<scenario>-<time>.json by default")
+    args = parser.parse_args()
+
+    summary, elapsed = run(run_against(args) if args.url else run_in_process(args))
+
+    print(f"{args.scenario}: {'burst of ' + str(args.burst) if args.burst else str(args.clients) + ' clients'}, "
+          f"{elapsed:.1f} s, {args.url or 'in-process'}")
+    print(f"{'request':<20}{'n':>8}{'err':>6}{'req/s':>9}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  ms")
+    for label, s in sorted(summary.items(), key=lambda kv: kv[0] == "all"):
+        print(f"{label:<20}{s['requests']:>8}{s['errors']:>6}{s['throughput']:>9.1f}{s['mean_ms']:>9.2f}"
+              f"{s['p50_ms']:>9.2f}{s['p95_ms']:>9.2f}{s['p99_ms']:>9.2f}{s['max_ms']:>9.2f}")
+
+    out = args.out or path.join(ROOT, "benchmarks", "results", f"{args.scenario}-{int(time())}.json")
+    makedirs(path.dirname(path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        f.write(dumps({
+            "scenario": args.scenario, "target": args.url or "in-process", "commit": _git_commit(),
+            "python": sys.version.split()[0], "clients": None if args.burst else args.clients,
+            "burst": args.burst or None, "every": args.every if args.burst else None,
+            "duration": elapsed, "timestamp": time(),
+            "env": {k: environ[k] for k in ("SCRYPT_N", "LOGIN_WORKERS", "LOGIN_QUEUE", "LOG_LEVEL") if k in environ},
+            "results": summary
+        }, indent=2))
+    print(f"\nresults written to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Handler time of /api/getData before and after precomputed serialization, without the
+sensor or token checks: only the formatting, response_model validation and encoding.
+
+    python benchmarks/bench_response.py [iterations]
+
+"before" is sub_frame + fmt_response + validating the dict against the Union response_model
+and encoding it, the way FastAPI does for a returned dict. "after" is the Record path used now.
+"""
+import sys
+from asyncio import run
+from os import path
+from time import perf_counter, time
+from typing import Any, Union
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+from models import HexDataResponse, HumanDataResponse, JSONDataResponse, Base64DataResponse  # noqa: E402
+from utils import Record, fmt_response, sub_frame  # noqa: E402
+
+FRAME = bytes.fromhex("0304018d00f2e1ba")
+RESPONSE: Any = Union[JSONDataResponse, HexDataResponse, Base64DataResponse, HumanDataResponse]
+FIELD = create_response_field(name="response", type_=RESPONSE)
+
+
+async def before(q: str, fmt: str, timestamp: float) -> bytes:
+    results = {"sensor": "am2320", "q": q, "reads": 2, "format": fmt, "delay": 2, "timestamp": timestamp,
+               "data": fmt_response(q, sub_frame(FRAME, q), fmt)}
+    content = await serialize_response(field=FIELD, response_content=results)
+    return JSONResponse(content).body
+
+
+async def after(record: Record, q: str, fmt: str, timestamp: float) -> bytes:
+    return record.response(("response", q, fmt, 2, 2, False), {
+        "sensor": "am2320", "q": q, "reads": 2, "format": fmt, "delay": 2, "timestamp": timestamp,
+        "stale": False, "data": record.render(q, fmt)})
+
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    timestamp = time()
+    record = Record(FRAME)
+    print(f"{n} calls per case, us per call")
+    print(f"{'q':<6}{'format':<8}{'before':>10}{'after':>10}{'speedup':>10}")
+    for q in ["all", "temp", "humi"]:
+        for fmt in ["json", "hex", "base64", "human"]:
+            assert await before(q, fmt, timestamp) == await after(record, q, fmt, timestamp)
+            t = perf_counter()
+            for _ in range(n):
+                await before(q, fmt, timestamp)
+            b = (perf_counter() - t) / n
+            t = perf_counter()
+            for _ in range(n):
+                await after(record, q, fmt, timestamp)
+            a = (perf_counter() - t) / n
+            print(f"{q:<6}{fmt:<8}{b * 1e6:10.2f}{a * 1e6:10.2f}{b / a:9.1f}x")
+
+
+if __name__ == "__main__":
+    run(main())
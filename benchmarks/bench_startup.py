@@ -0,0 +1,88 @@
+"""
+Startup cost of the app: `import main` measured with `python -X importtime`, and with
+--startup also the startup event (opening the sensors, loading the keys, opening the
+databases), in a fresh interpreter each run.
+
+    python benchmarks/bench_startup.py [--runs N] [--top N] [--startup]
+
+--startup needs the keys in keys/ and runs against the simulator (SENSOR_BACKEND=sim).
+"""
+import subprocess
+import sys
+from argparse import ArgumentParser
+from os import environ, path
+from statistics import median
+from typing import Dict, List, Tuple
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+HEAVY = ("jwcrypto", "cryptography")
+
+STARTUP = """
+from asyncio import run
+from time import perf_counter
+started = perf_counter()
+import main
+imported = perf_counter()
+app = main.create_app()
+created = perf_counter()
+async def startup():
+    await app.router.startup()
+    ready = perf_counter()
+    await app.router.shutdown()
+    return ready
+ready = run(startup())
+print(imported - started, created - imported, ready - created)
+"""
+
+
+def importtime() -> Tuple[int, Dict[str, int]]:
+    """
+    :return: cumulative µs of `import main`, cumulative µs per module
+    """
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT,
+                       capture_output=True, text=True, check=True)
+    modules: Dict[str, int] = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules["main"], modules
+
+
+def startup() -> List[float]:
+    env = dict(environ, SENSOR_BACKEND=environ.get("SENSOR_BACKEND", "sim"))
+    p = subprocess.run([sys.executable, "-c", STARTUP], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return [float(x) for x in p.stdout.split()]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--startup", action="store_true")
+    args = parser.parse_args()
+
+    totals = []
+    modules: Dict[str, int] = {}
+    for _ in range(args.runs):
+        total, modules = importtime()
+        totals.append(total)
+    print(f"import main: median {median(totals) / 1000:.1f} ms over {args.runs} runs "
+          f"(min {min(totals) / 1000:.1f}, max {max(totals) / 1000:.1f})")
+    loaded = [h for h in HEAVY if h in modules]
+    print(f"heavy modules imported by main: {', '.join(loaded) if loaded else 'none'}")
+    print(f"\nslowest top-level imports of the last run, cumulative ms:")
+    top = sorted(((us, name) for name, us in modules.items() if "." not in name and name != "main"), reverse=True)
+    for us, name in top[:args.top]:
+        print(f"{us / 1000:>10.1f}  {name}")
+
+    if args.startup:
+        runs = [startup() for _ in range(args.runs)]
+        print(f"\nmedian over {args.runs} runs, ms:")
+        for i, label in enumerate(["import main", "create_app()", "startup event"]):
+            print(f"{label:<16}{median(r[i] for r in runs) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
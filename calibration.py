@@ -0,0 +1,229 @@
+from collections import deque
+from json import dump, load
+from logging import Logger, getLogger
+from os import path, replace
+from time import sleep, time
+from typing import Callable, Deque, Dict, NamedTuple
+from bases.AM2320Base import AM2320Base
+from crc import frame_ok
+from tracing import ReadTrace
+
+
+class Timing(NamedTuple):
+    wakeup_delay: int       # µs after the wakeup byte
+    settle_delay: int       # µs between the request and reading the answer
+    timestamp: float = 0.0  # unix time of the calibration, 0 for the datasheet values
+
+
+DATASHEET = Timing(850, 1800)
+
+
+def apply(dev: AM2320Base, timing: Timing) -> None:
+    dev.wakeup_delay = timing.wakeup_delay
+    dev.settle_delay = timing.settle_delay
+
+
+def load_timings(file_path: str) -> Dict[str, Timing]:
+    """
+    Calibrated timings by sensor name, empty if `file_path` does not exist
+    """
+    if not path.exists(file_path):
+        return {}
+    with open(file_path) as f:
+        return {name: Timing(**t) for name, t in load(f).items()}
+
+
+def save_timing(file_path: str, name: str, timing: Timing) -> None:
+    timings = load_timings(file_path)
+    timings[name] = timing
+    tmp = file_path + ".tmp"
+    with open(tmp, "w") as f:
+        dump({n: t._asdict() for n, t in timings.items()}, f, indent=2)
+    replace(tmp, file_path)
+
+
+def _usleep(microseconds: int) -> None:
+    sleep(microseconds / 1000000)
+
+
+class Calibrator:
+    """
+    Finds the shortest wakeup and settle delays the attached sensor answers reliably with.
+
+    Each delay is binary searched between `floor` and the datasheet value, a candidate
+    passes when `trials` reads in a row succeed with a good CRC. The result is the
+    shortest passing delay times `margin`, never more than the datasheet value.
+    The settle delay is probed on an awake sensor. The wakeup delay only matters for a
+    sleeping sensor, so every wakeup trial first waits `sleep_after` seconds for the
+    sensor to fall asleep and a calibration takes about a minute.
+
+    Blocking: run it on the bus worker thread while holding the bus lock.
+    """
+    trials: int = 3
+    margin: float = 1.25
+    floor: int = 50         # µs
+    resolution: int = 25    # µs
+    sleep_after: float = 3.2
+    gap: float = 0.5        # seconds between trials on an awake sensor
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, dev: AM2320Base, trials: int = None, margin: float = None, sleep_after: float = None):
+        self.dev = dev
+        if trials:
+            self.trials = trials
+        if margin:
+            self.margin = margin
+        if sleep_after:
+            self.sleep_after = sleep_after
+
+    def _probe(self, wakeup: int, settle: int) -> bool:
+        """
+        One wakeup/request/read cycle of all four registers with the given delays
+        """
+        try:
+            try:
+                self.dev._send(b'\xff')
+            except OSError:
+                pass
+            _usleep(wakeup)
+            self.dev._send(b'\x03\x00\x04')
+            _usleep(settle)
+            return frame_ok(self.dev._recv(8))
+        except OSError:
+            return False
+
+    def _passes(self, wakeup: int, settle: int, asleep: bool) -> bool:
+        for _ in range(self.trials):
+            sleep(self.sleep_after if asleep else self.gap)
+            if not self._probe(wakeup, settle):
+                self.log.debug(f"wakeup {wakeup} µs, settle {settle} µs: failed")
+                return False
+        self.log.debug(f"wakeup {wakeup} µs, settle {settle} µs: ok")
+        return True
+
+    def _search(self, high: int, passes: Callable[[int], bool]) -> int:
+        """
+        The smallest delay in [floor, high] that passes, assuming `high` does and
+        that longer delays never do worse
+        """
+        low = self.floor
+        if passes(low):
+            return low
+        while high - low > self.resolution:
+            mid = (low + high) // 2
+            if passes(mid):
+                high = mid
+            else:
+                low = mid
+        return high
+
+    def run(self) -> Timing:
+        """
+        :raises IOError: if the sensor is not reliable even with the datasheet delays
+        """
+        if not self._passes(DATASHEET.wakeup_delay, DATASHEET.settle_delay, asleep=True):
+            raise IOError("Sensor does not answer reliably with the datasheet timing")
+        settle = self._search(DATASHEET.settle_delay,
+                              lambda s: self._passes(DATASHEET.wakeup_delay, s, asleep=False))
+        settle = min(round(settle * self.margin), DATASHEET.settle_delay)
+        wakeup = self._search(DATASHEET.wakeup_delay, lambda w: self._passes(w, settle, asleep=True))
+        wakeup = min(round(wakeup * self.margin), DATASHEET.wakeup_delay)
+        timing = Timing(wakeup, settle, time())
+        self.log.info(f"Calibrated {self.dev.i2c.path}: wakeup {wakeup} µs, settle {settle} µs")
+        return timing
+
+
+class AdaptiveTiming:
+    """
+    Trace hook that backs the delays off when errors rise and brings them back to the
+    calibrated values while reads are clean.
+
+    When `threshold` of the last `window` attempts failed (bad CRC or a bus error) both
+    delays are multiplied by `backoff`, up to twice the datasheet values. After `window`
+    clean attempts in a row they are multiplied by `recover`, down to `floor`.
+    """
+    window: int = 20
+    threshold: float = 0.1
+    backoff: float = 1.5
+    recover: float = 0.9
+    ceiling: Timing = Timing(2 * DATASHEET.wakeup_delay, 2 * DATASHEET.settle_delay)
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, dev: AM2320Base, floor: Timing = DATASHEET):
+        self.dev = dev
+        self.results: Deque[bool] = deque(maxlen=self.window)
+        self._clean = 0
+        self.reset(floor)
+
+    def reset(self, floor: Timing) -> None:
+        """
+        Use `floor` as the new calibrated timing and start from it
+        """
+        self.floor = floor
+        self.results.clear()
+        self._clean = 0
+        apply(self.dev, floor)
+
+    def _scale(self, factor: float) -> None:
+        dev = self.dev
+        wakeup = min(max(round(dev.wakeup_delay * factor), self.floor.wakeup_delay), self.ceiling.wakeup_delay)
+        settle = min(max(round(dev.settle_delay * factor), self.floor.settle_delay), self.ceiling.settle_delay)
+        if (wakeup, settle) != (dev.wakeup_delay, dev.settle_delay):
+            self.log.info(f"{dev.i2c.path}: wakeup {dev.wakeup_delay} -> {wakeup} µs, "
+                          f"settle {dev.settle_delay} -> {settle} µs")
+            dev.wakeup_delay = wakeup
+            dev.settle_delay = settle
+
+    def __call__(self, trace: ReadTrace) -> None:
+        failed = [not a.crc_ok for a in trace.attempts]
+        if trace.error not in (None, "crc", "cancelled"):
+            # a bus error, the attempt it ended has no entry
+            failed.append(True)
+        self.results.extend(failed)
+        if any(failed):
+            self._clean = 0
+            if sum(self.results) >= self.threshold * self.window:
+                self._scale(self.backoff)
+                self.results.clear()
+        else:
+            self._clean += len(failed)
+            if self._clean >= self.window:
+                self._scale(self.recover)
+                self._clean = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "wakeup_delay": self.dev.wakeup_delay,
+            "settle_delay": self.dev.settle_delay,
+            "calibrated": self.floor._asdict(),
+            "recent_errors": sum(self.results)
+        }
+
+
+if __name__ == "__main__":
+    # python calibration.py [--sim] [--bus /dev/i2c-1] [--name am2320] [--file calibration.json]
+    # calibrates the sensor and stores the result under its name
+    from argparse import ArgumentParser
+    from logger import setup_logging
+    from AM2320 import AM2320
+    from simulator import SimulatedAM2320Bus
+
+    parser = ArgumentParser(description="Calibrate AM2320 wakeup and settle delays")
+    parser.add_argument("--sim", action="store_true",
+                        help="calibrate a simulated sensor that needs 300 µs / 600 µs, with a short sleep timeout")
+    parser.add_argument("--bus", default=AM2320.I2C_BUS)
+    parser.add_argument("--name", default="am2320", help="sensor name in the sensors config")
+    parser.add_argument("--file", default="calibration.json")
+    args = parser.parse_args()
+    setup_logging("INFO")
+
+    i2c = None
+    sleep_after = None
+    if args.sim:
+        i2c = SimulatedAM2320Bus(min_wakeup=0.0003, min_settle=0.0006)
+        i2c.SLEEP_AFTER = 0.2
+        sleep_after = 0.25
+    dev = AM2320(bus=args.bus, loglevel="WARN", i2c=i2c)
+    result = Calibrator(dev, sleep_after=sleep_after).run()
+    save_timing(args.file, args.name, result)
+    print(result._asdict())
@@ -0,0 +1,69 @@
+from typing import Iterable, List
+
+
+def crc16_bitwise(data: bytes) -> int:
+    """
+    Modbus CRC16 (poly 0xA001 reflected, init 0xFFFF), one bit at a time.
+    This is the reference implementation, `crc16` must always agree with it.
+    """
+    crc = 0xFFFF
+    for i in data:
+        crc = crc ^ i
+        for bit in range(8):
+            if crc & 0x0001:
+                crc >>= 1
+                crc ^= 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+
+def _make_table() -> tuple:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 0x0001 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE: tuple = _make_table()
+
+
+def crc16(data: bytes, _table: tuple = CRC16_TABLE) -> int:
+    """
+    Modbus CRC16 with a 256-entry lookup table: one index and one shift per byte
+    instead of eight Python-level branches.
+    """
+    crc = 0xFFFF
+    for i in data:
+        crc = (crc >> 8) ^ _table[(crc ^ i) & 0xFF]
+    return crc
+
+
+def frame_ok(frame: bytes) -> bool:
+    """
+    Checks the CRC of a frame as sent by the sensor: [<payload>, crc_lo, crc_hi]
+    """
+    return len(frame) > 2 and crc16(frame[:-2]) == (frame[-1] << 8 | frame[-2])
+
+
+def crc16_many(frames: Iterable[bytes], _table: tuple = CRC16_TABLE) -> List[bool]:
+    """
+    Validates a batch of sensor frames (e.g. raw frames read back from the database)
+    in one pass, without a function call per frame.
+    :param frames: frames as sent by the sensor: [<payload>, crc_lo, crc_hi]
+    :return: one bool per frame, True if the CRC matches
+    """
+    result: List[bool] = []
+    append = result.append
+    for frame in frames:
+        if len(frame) < 3:
+            append(False)
+            continue
+        crc = 0xFFFF
+        for i in frame[:-2]:
+            crc = (crc >> 8) ^ _table[(crc ^ i) & 0xFF]
+        append(crc == (frame[-1] << 8 | frame[-2]))
+    return result
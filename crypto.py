@@ -1,30 +1,101 @@
+from asyncio import get_running_loop, wrap_future
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from hashlib import sha256
 from os import environ, urandom
-from jwcrypto.jws import JWS, JWK, json_encode, JWException   # type: ignore
-from dotenv import load_dotenv
-from cryptography.hazmat.primitives.kdf.scrypt import Scrypt, InvalidKey, UnsupportedAlgorithm
-from base64 import b64decode
+from typing import TYPE_CHECKING, Tuple
+from base64 import b64decode, b64encode
 from bases.JSONTokenBase import JSONTokenBase, Dict
-from sqlite import init_db, get_user, add_demo_user
+from sqlite import ConnectionPool, get_user, update_user_hash
+from metrics import REGISTRY
 
-db = init_db(f"users.db")
-add_demo_user(db)
+# jwcrypto and cryptography take a good part of a second to import on a Pi Zero, they
+# are imported where they are first needed instead of here
+if TYPE_CHECKING:
+    from jwcrypto.jws import JWS, JWK  # type: ignore
 
-load_dotenv()
+JWT_SIGN = REGISTRY.histogram("jwt_sign_seconds", "Time to sign a token")
+JWT_VERIFY = REGISTRY.histogram("jwt_verify_seconds", "Time to deserialize and verify a token (cache misses)")
+SCRYPT_VERIFY = REGISTRY.histogram("scrypt_verify_seconds", "Time to check a password against its scrypt hash")
+LOGINS_REJECTED = REGISTRY.counter("login_rejected_total", "Logins refused because the scrypt pool was full")
+
+
+class TokenCache:
+    """
+    Bounded LRU of tokens that already passed signature verification, keyed by the
+    SHA-256 of the compact serialization. Stores only `exp` and `nbf`, so a hit costs
+    a hash and two comparisons instead of an Ed448 verification.
+    Entries are dropped when they expire and all of them when the public key changes.
+    """
+    maxsize: int = 1024
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, maxsize: int = None):
+        if maxsize:
+            self.maxsize = maxsize
+        self._entries: OrderedDict[bytes, Tuple[int | None, int | None]] = OrderedDict()
+        self._key: "JWK | None" = None
+        self._key_thumbprint: str | None = None
+
+    def _check_key(self, public_key: "JWK") -> None:
+        if public_key is self._key:
+            return
+        thumbprint = public_key.thumbprint()
+        if thumbprint != self._key_thumbprint:
+            self._entries.clear()
+        self._key, self._key_thumbprint = public_key, thumbprint
+
+    def get(self, token_string: str, public_key: "JWK", now: int) -> bool:
+        """
+        :return: True if the token was verified against `public_key` before and is valid at `now`
+        """
+        self._check_key(public_key)
+        digest = sha256(token_string.encode()).digest()
+        entry = self._entries.get(digest)
+        if entry is not None:
+            exp, nbf = entry
+            if exp is not None and exp <= now:
+                del self._entries[digest]
+            elif nbf is None or nbf <= now:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def put(self, token_string: str, public_key: "JWK", exp: int | None, nbf: int | None) -> None:
+        self._check_key(public_key)
+        self._entries[sha256(token_string.encode()).digest()] = (exp, nbf)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
 
 
 class JSONToken(JSONTokenBase):
-    token: JWS = JWS()
-    __private_key: JWK
-    public_key: JWK
+    __private_key: "JWK"
+    public_key: "JWK"
+    cache: TokenCache
 
     def __init__(self, private_key_path: str, public_key_path: str):
         super(JSONToken, self).__init__()
         self.__private_key = self.__load_private_key(
             path=private_key_path, passphrase=environ.get("PRIVATE_KEY_PASSPHRASE"))  # type: ignore
         self.public_key = self.__load_public_key(path=public_key_path)
+        self.cache = TokenCache(int(environ.get("TOKEN_CACHE_SIZE", TokenCache.maxsize)))
+        REGISTRY.gauge("jwt_cache_hits", "Verified-token cache hits").set_function(lambda: self.cache.hits)
+        REGISTRY.gauge("jwt_cache_misses", "Verified-token cache misses").set_function(lambda: self.cache.misses)
+        REGISTRY.gauge("jwt_cache_size", "Tokens in the verified-token cache").set_function(
+            lambda: len(self.cache._entries))
 
     def __load_key(self, path: str, passphrase: str = None):
+        from jwcrypto.jwk import JWK  # type: ignore
         jwk = JWK()
         f = open(file=path, mode="rb")
         data = f.read()
@@ -41,28 +112,34 @@ class JSONToken(JSONTokenBase):
     def __load_private_key(self, path: str, passphrase: str):
         return self.__load_key(path, passphrase)
 
-    def sign(self, payload: Dict[str, str]) -> JWS:
-        payload["nonce"] = urandom(32).hex()
-        t = JWS(json_encode(payload))
-        iat = datetime.utcnow().timestamp().__trunc__()
-        t.add_signature(
-            key=self.__private_key,
-            alg=None,
-            protected=json_encode({
-                "alg": "EdDSA",
-                "typ": "jwt",
-                "iat": iat,
-                "exp": iat + 3600,
-                "nbf": iat - 120
-            })
-        )
+    def sign(self, payload: Dict[str, str]) -> "JWS":
+        from jwcrypto.jws import JWS, json_encode  # type: ignore
+        with JWT_SIGN.time():
+            payload["nonce"] = urandom(32).hex()
+            t = JWS(json_encode(payload))
+            iat = datetime.utcnow().timestamp().__trunc__()
+            t.add_signature(
+                key=self.__private_key,
+                alg=None,
+                protected=json_encode({
+                    "alg": "EdDSA",
+                    "typ": "jwt",
+                    "iat": iat,
+                    "exp": iat + 3600,
+                    "nbf": iat - 120
+                })
+            )
         return t
 
     @staticmethod
-    def verify(token_string: str, public_key: JWK) -> None:
-        t = JWS()
-        t.deserialize(raw_jws=token_string, key=public_key)
+    def verify(token_string: str, public_key: "JWK", cache: TokenCache = None) -> None:
         now = datetime.utcnow().timestamp().__trunc__()
+        if cache is not None and cache.get(token_string, public_key, now):
+            return
+        from jwcrypto.jws import JWS, JWException  # type: ignore
+        t = JWS()
+        with JWT_VERIFY.time():
+            t.deserialize(raw_jws=token_string, key=public_key)
         headers = t.jose_header
         is_valid = False
         for x in headers:
@@ -76,19 +153,109 @@ class JSONToken(JSONTokenBase):
                 is_valid = True
         if not is_valid:
             raise JWException("Headers did not pass validation")
+        if cache is not None:
+            cache.put(token_string, public_key, headers.get("exp"), headers.get("nbf"))
 
 
-def validate_credentials(username: str, password: str):
-    encoded_hash = get_user(db, username)
-    if not encoded_hash:
-        return False
+def hash_password(password: str, n: int, r: int, p: int, salt_len: int = 16, key_len: int = 64) -> str:
+    """
+    :return: encoded hash in the format stored in the users table: SCRYPT:n:r:p:<salt>:<key>
+    """
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+    salt = urandom(salt_len)
+    key = Scrypt(salt, key_len, n, r, p).derive(password.encode("utf8"))
+    return f"SCRYPT:{n}:{r}:{p}:{b64encode(salt).decode()}:{b64encode(key).decode()}"
+
+
+def check_password(encoded_hash: str, password: str) -> bool:
+    from cryptography.exceptions import InvalidKey, UnsupportedAlgorithm
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
     algo, n, r, p, salt, key = encoded_hash.split(":")
     if algo != "SCRYPT":
         raise UnsupportedAlgorithm("Only SCRYPT is supported")
     key_len = len(b64decode(key))
     scrypt = Scrypt(b64decode(salt), key_len, int(n), int(r), int(p))
     try:
-        scrypt.verify(password.encode("utf8"), b64decode(key))
+        with SCRYPT_VERIFY.time():
+            scrypt.verify(password.encode("utf8"), b64decode(key))
         return True
     except InvalidKey:
         return False
+
+
+def validate_credentials(db: ConnectionPool, username: str, password: str):
+    encoded_hash = get_user(db, username)
+    if not encoded_hash:
+        return False
+    return check_password(encoded_hash, password)
+
+
+class Overloaded(Exception):
+    pass
+
+
+class CredentialVerifier:
+    """
+    Runs the scrypt checks of `/api/authorize` on a bounded thread pool so they do not
+    block the event loop. OpenSSL's scrypt runs without the GIL, `max_workers` caps how
+    many run at once (and how much memory they take), `max_queue` how many may wait for
+    a worker before new logins are refused with `Overloaded`.
+
+    If `cost` (n, r, p) is given, hashes stored with other parameters are re-hashed with
+    it after a successful login.
+    """
+    max_workers: int = 1
+    max_queue: int = 4
+    cost: Tuple[int, int, int] | None = None
+
+    def __init__(self, db: ConnectionPool, max_workers: int = None, max_queue: int = None,
+                 cost: Tuple[int, int, int] = None):
+        """
+        :param db: the users database
+        """
+        self.db = db
+        if max_workers:
+            self.max_workers = max_workers
+        if max_queue is not None:
+            self.max_queue = max_queue
+        if cost:
+            self.cost = cost
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="scrypt")
+        self._pending = 0
+        REGISTRY.gauge("login_pending", "Logins running or waiting for a scrypt worker").set_function(
+            lambda: self._pending)
+
+    def _needs_rehash(self, encoded_hash: str) -> bool:
+        if not self.cost:
+            return False
+        _, n, r, p, _, _ = encoded_hash.split(":")
+        return (int(n), int(r), int(p)) != self.cost
+
+    def _check(self, username: str, password: str) -> bool:
+        # runs on the pool: the user lookup and the re-hash write are SQLite calls,
+        # the pool gives each worker thread its own connection
+        encoded_hash = get_user(self.db, username)
+        if not encoded_hash or not check_password(encoded_hash, password):
+            return False
+        if self._needs_rehash(encoded_hash):
+            update_user_hash(self.db, username, hash_password(password, *self.cost))  # type: ignore
+        return True
+
+    async def validate(self, username: str, password: str) -> bool:
+        """
+        Async version of `validate_credentials`
+        :raises Overloaded: if `max_workers + max_queue` checks are already in progress
+        """
+        if self._pending >= self.max_workers + self.max_queue:
+            LOGINS_REJECTED.inc()
+            raise Overloaded("Too many concurrent logins")
+        loop = get_running_loop()
+        job = self.executor.submit(self._check, username, password)
+        self._pending += 1
+        # released when the check is done, not when the caller stops waiting: the scrypt
+        # of a request that was cancelled keeps its worker until it finishes
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        return await wrap_future(job, loop=loop)
+
+    def _release(self) -> None:
+        self._pending -= 1
@@ -0,0 +1,87 @@
+"""
+Sensor daemon: the one process that owns the I2C buses when the API runs with several
+workers. It polls the sensors, records the readings and publishes the latest sample of
+every sensor to shared memory (see shared.py), where the workers read it.
+
+The readings are written to the database after every sweep rather than in batches: the
+workers serve /api/history and /api/export from the database and cannot see readings the
+daemon still holds, so those lag /api/getData by at most one sample interval.
+
+    SHARED_SAMPLES=templogger python daemon.py
+    SHARED_SAMPLES=templogger uvicorn main:app --workers 4
+
+Configured with the same environment variables (and .env) as the app.
+"""
+from asyncio import Event, TimeoutError, get_running_loop, run, to_thread, wait_for
+from logging import Logger, getLogger
+from os import environ
+from signal import SIGINT, SIGTERM
+from dotenv import load_dotenv
+from history import ReadingRecorder
+from logger import configure_logging
+from sampler import Sample
+from sensors import SensorRegistry, Scheduler, open_sensors
+from shared import SampleBoard
+from utils import env_flag
+
+log: Logger = getLogger(__name__)
+
+
+class SensorDaemon:
+    """
+    Sweeps the sensors every `interval` seconds and publishes every result, new samples and
+    the stale ones served while a breaker is open, then marks the sweep in the board header
+    and writes the sweep's readings in one transaction.
+    """
+    interval: float = Scheduler.interval
+
+    def __init__(self, board_name: str, registry: SensorRegistry, recorder: ReadingRecorder,
+                 interval: float = None):
+        if interval:
+            self.interval = interval
+        self.registry = registry
+        self.recorder = recorder
+        self.scheduler = Scheduler(registry, self.interval)
+        self.board = SampleBoard.create(board_name, list(registry.sensors), self.interval)
+        registry.subscribe(recorder.record)
+
+    async def run(self, stop: Event) -> None:
+        await self.recorder.start()
+        if env_flag("CALIBRATE"):
+            self.registry.start_calibration()
+        log.info(f"Publishing {len(self.registry.sensors)} sensors to shared memory '{self.board.shm.name}'")
+        try:
+            while not stop.is_set():
+                for result in (await self.scheduler.sweep()).values():
+                    if isinstance(result, Sample):
+                        self.board.publish(result)
+                self.board.beat()
+                await self.recorder.flush()
+                try:
+                    await wait_for(stop.wait(), self.interval)
+                except TimeoutError:
+                    pass
+        finally:
+            await self.recorder.stop()
+            self.registry.close()
+            self.board.close()
+
+
+async def main() -> None:
+    load_dotenv()
+    configure_logging()
+    stop = Event()
+    for sig in (SIGINT, SIGTERM):
+        get_running_loop().add_signal_handler(sig, stop.set)
+    registry = await to_thread(open_sensors)
+    recorder = ReadingRecorder(
+        environ.get("READINGS_DB", "readings.db"),
+        batch_size=int(environ.get("READINGS_BATCH", ReadingRecorder.batch_size)),
+        flush_interval=float(environ.get("READINGS_FLUSH_INTERVAL", ReadingRecorder.flush_interval)))
+    daemon = SensorDaemon(environ.get("SHARED_SAMPLES", "templogger"), registry, recorder,
+                          interval=float(environ.get("SAMPLE_INTERVAL", Scheduler.interval)))
+    await daemon.run(stop)
+
+
+if __name__ == "__main__":
+    run(main())
@@ -0,0 +1,121 @@
+from json import dumps
+from sqlite3 import connect
+from struct import Struct
+from typing import Iterable, Iterator, Tuple
+from zlib import compressobj
+from sqlite import get_readings
+from utils import fmt_response, sub_frame
+
+Row = Tuple[float, float, float, bytes, int]
+
+FORMATS = ["json", "hex", "base64", "human", "ndjson", "csv", "binary"]
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "binary": "application/octet-stream"
+}
+
+# binary export: header, then one fixed-width little-endian record per reading
+BINARY_MAGIC = b"TLOG"
+BINARY_VERSION = 1
+BINARY_RECORD = Struct("<dHhB")    # unix timestamp, humidity * 10, temperature * 10, crc_retries
+BINARY_HEADER = Struct("<4sBB")    # magic, version, record size
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_readings(db_path: str, sensor: str, ts_from: float, ts_to: float, page: int = 1000) -> Iterator[Row]:
+    """
+    Yields every stored reading of `sensor` in the range, oldest first, one keyset page
+    at a time, so memory use does not depend on the size of the range.
+    Uses its own read-only connection, it may be advanced from any thread but only one at a time.
+    """
+    db = connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    try:
+        after = None
+        while True:
+            rows = get_readings(db, sensor, ts_from, ts_to, after, page)
+            yield from rows
+            if len(rows) < page:
+                return
+            after = rows[-1][0]
+    finally:
+        db.close()
+
+
+def _json_array(rows: Iterable[Row], q: str, fmt: str) -> Iterator[bytes]:
+    # the fmt_response formats, as one JSON array streamed element by element
+    yield b"["
+    sep = b""
+    for r in rows:
+        yield sep + dumps({"timestamp": r[0], "data": fmt_response(q, sub_frame(r[3], q), fmt)},
+                          separators=(",", ":")).encode()
+        sep = b","
+    yield b"]"
+
+
+def _ndjson(rows: Iterable[Row], sensor: str) -> Iterator[bytes]:
+    for r in rows:
+        yield dumps({"sensor": sensor, "timestamp": r[0], "humi": r[1], "temp": r[2], "crc_retries": r[4]},
+                    separators=(",", ":")).encode() + b"\n"
+
+
+def _csv(rows: Iterable[Row], sensor: str) -> Iterator[bytes]:
+    yield b"sensor,timestamp,humi,temp,crc_retries\r\n"
+    s = sensor.replace('"', '""')
+    for r in rows:
+        yield f'"{s}",{r[0]},{r[1]},{r[2]},{r[4]}\r\n'.encode()
+
+
+def _binary(rows: Iterable[Row]) -> Iterator[bytes]:
+    yield BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_RECORD.size)
+    pack = BINARY_RECORD.pack
+    for r in rows:
+        yield pack(r[0], round(r[1] * 10), round(r[2] * 10), min(r[4], 255))
+
+
+def _chunked(parts: Iterable[bytes], size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    # one send per ~64 KiB instead of one per row
+    buf = bytearray()
+    for p in parts:
+        buf += p
+        if len(buf) >= size:
+            yield bytes(buf)
+            buf.clear()
+    if buf:
+        yield bytes(buf)
+
+
+def _gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    z = compressobj(6, wbits=31)
+    for c in chunks:
+        out = z.compress(c)
+        if out:
+            yield out
+    yield z.flush()
+
+
+def export(rows: Iterable[Row], sensor: str, fmt: str, q: str = "all", compress: bool = False) -> Iterator[bytes]:
+    """
+    Streams `rows` in the requested format in chunks of about 64 KiB
+    :param fmt: one of FORMATS
+    :param q: all, temp or humi, only used by the fmt_response formats
+    :param compress: gzip the stream
+    """
+    match fmt:
+        case "ndjson":
+            parts = _ndjson(rows, sensor)
+        case "csv":
+            parts = _csv(rows, sensor)
+        case "binary":
+            parts = _binary(rows)
+        case "json" | "hex" | "base64" | "human":
+            parts = _json_array(rows, q, fmt)
+        case _:
+            raise ValueError(f"Format should be one of {', '.join(FORMATS)}")
+    chunks = _chunked(parts)
+    return _gzip(chunks) if compress else chunks
+
+
+def media_type(fmt: str) -> str:
+    return MEDIA_TYPES.get(fmt, "application/json")
@@ -0,0 +1,96 @@
+from asyncio import Task, CancelledError, create_task, get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger, getLogger
+from sqlite3 import Connection
+from typing import List, Tuple
+from sampler import Sample
+from sqlite import init_readings_db, insert_readings, get_readings
+from utils import Record
+
+
+class ReadingRecorder:
+    """
+    Buffers samples in memory and writes them to the `readings` table in batches,
+    one transaction per batch. All database work runs on a single worker thread.
+    """
+    batch_size: int = 60
+    flush_interval: float = 300
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, db_path: str, batch_size: int = None, flush_interval: float = None):
+        if batch_size:
+            self.batch_size = batch_size
+        if flush_interval:
+            self.flush_interval = flush_interval
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.db: Connection | None = None
+        self._pending: List[Tuple[str, float, float, float, bytes, int]] = []
+        self._task: Task | None = None
+        self._flushes: set[Task] = set()
+
+    async def _run_db(self, fn, *args):
+        return await get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def start(self) -> None:
+        self.db = await self._run_db(init_readings_db, self.db_path)
+        self._task = create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.db is not None:
+            await self._run_db(self.db.close)
+        self.executor.shutdown()
+
+    async def _run(self) -> None:
+        while True:
+            await sleep(self.flush_interval)
+            await self.flush()
+
+    def record(self, sample: Sample) -> None:
+        """
+        Sampler listener, queues the sample for the next batch.
+        """
+        record = sample.record or Record(sample.frame)
+        self._pending.append((sample.sensor, sample.timestamp, record.humi, record.temp,
+                              sample.frame, sample.crc_retries))
+        if len(self._pending) >= self.batch_size:
+            t = create_task(self.flush())
+            self._flushes.add(t)
+            t.add_done_callback(self._flushes.discard)
+
+    async def flush(self) -> None:
+        if not self._pending or self.db is None:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            n = await self._run_db(insert_readings, self.db, rows)
+            self.log.debug(f"Wrote {n} readings")
+        except Exception as e:
+            # keep the rows for the next attempt instead of losing them
+            self.log.error(f"Writing {len(rows)} readings failed: {e!r}")
+            self._pending[:0] = rows
+
+    async def history(self, sensor: str, ts_from: float, ts_to: float,
+                      after: float | None = None, limit: int = 500) -> List[Tuple[float, float, float, bytes, int]]:
+        """
+        One page of stored readings, see `sqlite.get_readings`. Readings still waiting
+        for the next batch are appended when the page is not full, they are always
+        newer than what is on disk.
+        """
+        rows = await self._run_db(get_readings, self.db, sensor, ts_from, ts_to, after, limit)
+        if len(rows) < limit:
+            last = rows[-1][0] if rows else after
+            for r in self._pending:
+                if r[0] == sensor and ts_from <= r[1] <= ts_to and (last is None or r[1] > last):
+                    rows.append(r[1:])
+                    if len(rows) == limit:
+                        break
+        return rows
@@ -0,0 +1,80 @@
+from os import open, close, write, read, O_RDWR
+from fcntl import ioctl  # type: ignore
+from logging import Logger, getLogger
+from bases.I2CBusBase import I2CBusBase
+
+
+class LinuxI2CBus(I2CBusBase):
+    """
+    /dev/i2c-N character device, slave selected with the I2C_SLAVE ioctl
+    """
+    IOCTL_CMD: int = 0x0703
+    fd: int | None = None
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, path: str, addr: int, ioctl_cmd: int = None):
+        self.path = path
+        self.addr = addr
+        if ioctl_cmd:
+            self.IOCTL_CMD = ioctl_cmd
+
+    def open(self) -> None:
+        if self.fd is not None:
+            return
+        self.log.debug(f"Opening bus '{self.path}'")
+        self.fd = open(self.path, O_RDWR)
+        self.log.debug(f"calling ioctl() with command '{hex(self.IOCTL_CMD)}' "
+                       f"on I2C address '{hex(self.addr)}'")
+        ioctl(self.fd, self.IOCTL_CMD, self.addr)
+
+    def close(self) -> None:
+        if self.fd is not None:
+            close(self.fd)
+            self.fd = None
+
+    def write(self, b: bytes) -> int:
+        return write(self.fd, b)  # type: ignore
+
+    def read(self, length: int) -> bytes:
+        return read(self.fd, length)  # type: ignore
+
+
+class MuxedI2CBus(I2CBusBase):
+    """
+    Device behind one channel of a TCA9548A style I2C multiplexer. The channel is
+    selected by writing a bit mask to the mux before talking to the device, but only
+    when the mux is not already on that channel. All devices behind one mux must share
+    the same `mux` object, and a whole transaction must hold the bus lock.
+    """
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, device: I2CBusBase, mux: I2CBusBase, channel: int):
+        if not 0 <= channel <= 7:
+            raise ValueError("Mux channel should be between 0 and 7")
+        self.device = device
+        self.mux = mux
+        self.channel = channel
+        self.path = device.path
+        self.addr = device.addr
+
+    def _select(self) -> None:
+        if getattr(self.mux, "selected", None) != self.channel:
+            self.log.debug(f"Selecting mux channel {self.channel} on '{self.path}'")
+            self.mux.write(bytes([1 << self.channel]))
+            self.mux.selected = self.channel  # type: ignore
+
+    def open(self) -> None:
+        self.mux.open()
+        self.device.open()
+
+    def close(self) -> None:
+        self.device.close()
+        self.mux.close()
+
+    def write(self, b: bytes) -> int:
+        self._select()
+        return self.device.write(b)
+
+    def read(self, length: int) -> bytes:
+        self._select()
+        return self.device.read(length)
@@ -1,4 +1,17 @@
+import atexit
 import logging
+from copy import copy
+from json import dumps
+from logging.handlers import QueueHandler, QueueListener
+from os import environ
+from queue import Full, Queue
+from random import random
+from threading import Lock
+from typing import Dict, List, TextIO
+
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+# attributes every LogRecord has, anything else came in through `extra`
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
 
 
 def level_matcher(level: str):
@@ -7,29 +20,186 @@ def level_matcher(level: str):
             return logging.DEBUG
         case "INFO":
             return logging.INFO
-        case "WARN":
+        case "WARN" | "WARNING":
             return logging.WARN
+        case "ERROR":
+            return logging.ERROR
+        case "CRITICAL":
+            return logging.CRITICAL
         case _:
-            raise ValueError("Invalid loglevel. Currently only DEBUG, INFO and WARN are supported")
+            raise ValueError("Invalid loglevel. Supported are DEBUG, INFO, WARN, ERROR and CRITICAL")
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, thread, message, the traceback if
+    there is one and every field passed with `extra`
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        return dumps(entry, default=str, separators=(",", ":"))
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Keeps chatty loggers affordable: records below `max_level` are first sampled (a
+    `sample` fraction is kept) and then pass a token bucket per logger, `rate` records per
+    second with bursts of `burst`. Warnings and errors always pass. The first record let
+    through after some were dropped says how many.
+    """
+    max_level: int = logging.WARN
+    burst: int = 20
+
+    def __init__(self, rate: float = 0, burst: int = None, sample: float = 1.0):
+        """
+        :param rate: records per second per logger, 0 for no limit
+        """
+        super().__init__()
+        self.rate = rate
+        if burst:
+            self.burst = burst
+        self.sample = sample
+        self._lock = Lock()
+        self._buckets: Dict[str, List[float]] = {}     # logger -> [tokens, last refill]
+        self.dropped: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.max_level:
+            return True
+        if self.sample < 1.0 and random() >= self.sample:
+            return False
+        if not self.rate:
+            return True
+        name, now = record.name, record.created
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = self._buckets[name] = [float(self.burst), now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.dropped[name] = self.dropped.get(name, 0) + 1
+                return False
+            bucket[0] -= 1
+            dropped = self.dropped.pop(name, 0)
+        if dropped:
+            record.msg = f"{record.getMessage()} ({dropped} earlier messages suppressed)"
+            record.args = None
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    """
+    Never blocks the caller: when the queue is full the record is dropped and counted.
+    Only the message is formatted here, the formatter of the listener does the rest.
+    """
+    dropped: int = 0
+    _exceptions = logging.Formatter()
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # message and traceback become strings, so the record holds no references to
+        # arguments or frames that could change before the listener thread formats it
+        record = copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exceptions.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _State:
+    handler: _QueueHandler | None = None
+    listener: QueueListener | None = None
+    output: logging.Handler | None = None
+
+
+_state = _State()
+_setup_lock = Lock()
+
+
+def setup_logging(level: str = "INFO", json: bool = False, rate: float = 0, burst: int = None,
+                  sample: float = 1.0, queue_size: int = 10000, stream: TextIO = None) -> logging.Logger:
+    """
+    Routes the root logger through a queue to a listener thread that does the formatting
+    and the writing, so logging from the event loop or a bus worker is a put_nowait.
+    Idempotent: the first call installs the handler and starts the listener, later calls
+    only change the level, the format and the rate limit.
+    :param json: one JSON object per line instead of text
+    :param rate: records below WARN per second per logger, 0 for no limit, see `RateLimitFilter`
+    :param sample: fraction of the records below WARN to keep
+    :return: the root logger
+    """
+    root = logging.getLogger()
+    with _setup_lock:
+        if _state.handler is None:
+            queue: Queue = Queue(queue_size)
+            _state.output = logging.StreamHandler(stream)
+            _state.handler = _QueueHandler(queue)
+            _state.listener = QueueListener(queue, _state.output)
+            _state.listener.start()
+            atexit.register(stop_logging)
+            root.addHandler(_state.handler)
+        _state.output.setFormatter(JSONFormatter() if json else logging.Formatter(TEXT_FORMAT))   # type: ignore
+        for f in list(_state.handler.filters):
+            _state.handler.removeFilter(f)
+        if rate or sample < 1.0:
+            _state.handler.addFilter(RateLimitFilter(rate, burst, sample))
+        root.setLevel(level_matcher(level))
+    return root
+
+
+def configure_logging() -> logging.Logger:
+    """
+    `setup_logging` configured from the environment: LOG_LEVEL, LOG_FORMAT=json, and
+    LOG_RATE, LOG_BURST and LOG_SAMPLE for the records below WARN
+    """
+    return setup_logging(environ.get("LOG_LEVEL", "INFO"), json=environ.get("LOG_FORMAT") == "json",
+                         rate=float(environ.get("LOG_RATE", 0)), burst=int(environ.get("LOG_BURST", 0)),
+                         sample=float(environ.get("LOG_SAMPLE", 1)))
+
+
+def stop_logging() -> None:
+    """
+    Writes out what is still queued and stops the listener
+    """
+    with _setup_lock:
+        if _state.listener is not None:
+            _state.listener.stop()
+            logging.getLogger().removeHandler(_state.handler)   # type: ignore
+            _state.handler = _state.listener = _state.output = None
 
 
 def setup_logger(level: str) -> logging.Logger:
-    logger = logging.getLogger()
-    frmt = logging.Formatter('%(asctime)s [%(levelname)s]: %(message)s')
-    ch = logging.StreamHandler()
-    ch.setFormatter(frmt)
-    logger.setLevel(level_matcher(level))
-    ch.setLevel(level_matcher(level))
-    logger.addHandler(ch)
-    return logger
+    """
+    Kept for old callers, same as `setup_logging(level)`
+    """
+    return setup_logging(level)
 
 
 def init_logger(loglevel: str = "WARN"):
-    if loglevel not in ["DEBUG", "INFO", "WARN", "ERROR"]:
-        raise ValueError("Invalid loglevel provided")
-    logger = setup_logger(loglevel)
+    logger = setup_logging(loglevel)
     logger.debug(f"Logger module initialized")
     logger.info(f"Loglevel set to '{loglevel}'")
 
     return logger
-
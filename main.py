@@ -1,15 +1,33 @@
 from base64 import b64decode
-from fastapi import FastAPI, Header, HTTPException, Query
-from fastapi.responses import JSONResponse
-from fastapi.middleware import cors, gzip, trustedhost, Middleware
-from starlette.middleware.base import BaseHTTPMiddleware, Request, Response, RequestResponseEndpoint
-from starlette.status import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_500_INTERNAL_SERVER_ERROR
-from typing import Union
-from crypto import JSONToken, validate_credentials
-from jwcrypto.jws import InvalidJWSSignature, InvalidJWSObject, JWKeyNotFound, JWException  # type: ignore
-from AM2320 import AM2320
-from models import HexDataResponse, HumanDataResponse, JSONDataResponse, Base64DataResponse, AuthResponse
-from utils import fmt_response
+from os import environ
+from time import time
+from asyncio import FIRST_COMPLETED, TimeoutError, create_task, gather, to_thread, wait, wait_for
+from json import dumps
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Query, WebSocket
+from fastapi.responses import Response, StreamingResponse
+from fastapi.middleware import cors, trustedhost, Middleware
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_404_NOT_FOUND, \
+    HTTP_500_INTERNAL_SERVER_ERROR, HTTP_503_SERVICE_UNAVAILABLE
+from typing import Dict, List, Union
+from urllib.parse import parse_qs
+from dotenv import load_dotenv
+from starlette.requests import HTTPConnection
+from crypto import JSONToken, CredentialVerifier, Overloaded, hash_password
+from models import HexDataResponse, HumanDataResponse, JSONDataResponse, Base64DataResponse, AuthResponse, \
+    HistoryResponse, BatchRequest, BatchResponse
+from export import FORMATS, export, iter_readings, media_type
+from history import ReadingRecorder
+from logger import configure_logging
+from metrics import REGISTRY, CONTENT_TYPE
+from middleware import SecurityMiddleware, SelectiveGZipMiddleware
+from sensors import SensorRegistry, Scheduler, open_sensors
+from shared import SharedSensors
+from stats import Stats
+from store import SampleStore
+from sqlite import add_demo_user, get_pool, get_user, init_db
+from stream import Broadcaster
+from tokens import TokenRegistry
+from utils import DATA_FORMATS, QUANTITIES, Record, env_flag
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -23,10 +41,6 @@ from utils import fmt_response
 #   - issue separate renewal token?
 #   - set max_age for such token?
 #
-# TODO: keep track of issued tokens for the past n hours
-#   - allow only one live token per user
-#   - find out easiest way to invalidate any excess tokens
-#
 # TODO: publish /docs and/or /redoc to public
 #   - fix documentation
 #
@@ -35,67 +49,162 @@ from utils import fmt_response
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
-dev = AM2320(loglevel="INFO")
-jwt = JSONToken(private_key_path=f"keys/private_key.pem",
-                public_key_path=f"keys/pubkey.pem")
-
-
-class MyMiddleware(BaseHTTPMiddleware):
-    async def dispatch(
-        self, req: Request, call_next: RequestResponseEndpoint
-    ) -> Response:
-        err_res = JSONResponse(status_code=HTTP_401_UNAUTHORIZED, content={
-            "code": HTTP_401_UNAUTHORIZED, "message": "Unauthorized"})
-        if req.headers.get("x-real-ip") != req.headers.get("x-forwarded-for"):
-            return err_res
-        if not req.headers.get("x-nginx-proxy") or req.headers.get("x-nginx-proxy") != "true":
-            return err_res
-
-        print(f"<<< Incoming request...")
-        for header in req.headers.raw:
-            key, value = header
-            print(f"< '{key.decode()}: {value.decode()}'")
-        print()
-
-        print(f">>> Outgoing response...")
-        res = await call_next(req)
-        for k, v in [
-            ("strict-transport-security",
-             "max-age=63072000; includeSubDomains; preload"),
-            ("X-Frame-Options", "DENY"),
-            ("X-Content-Type-Options", "nosniff"),
-            ("X-XSS-Protection", "1; mode=block")
-        ]:
-            res.headers.append(k, v)
-
-        for header in res.headers.raw:
-            key, value = header
-            print(f"> '{key.decode()}: {value.decode()}'")
-        print()
-
-        return res
-
-
-middlewares = [
-    Middleware(cors.CORSMiddleware,
-               allow_origins=["https://logger.sokru.fi"],
-               allow_methods=["GET", "POST", "HEAD"]),
-    Middleware(gzip.GZipMiddleware, compresslevel=6),
-    Middleware(trustedhost.TrustedHostMiddleware,
-               allowed_hosts=["logger.sokru.fi"]),
-    Middleware(MyMiddleware)
-]
-
-app = FastAPI(middleware=middlewares)
-
-
-@app.get("/")
+class Services:
+    """
+    Everything the routes use. Creating it only reads the configuration, start() opens the
+    I2C buses, loads the keys and opens the users database, in parallel on worker threads.
+
+    With SHARED_SAMPLES set the buses belong to the sensor daemon (daemon.py), which also
+    records the readings, and this process reads the samples from its shared memory.
+    Needed for more than one uvicorn worker.
+    """
+    DEFAULT_COST = (2 ** 14, 8, 1)
+
+    def __init__(self):
+        self.shared_samples = environ.get("SHARED_SAMPLES")
+        self.users = get_pool(environ.get("USERS_DB", "users.db"))
+        cost = (int(environ["SCRYPT_N"]), int(environ.get("SCRYPT_R", 8)), int(environ.get("SCRYPT_P", 1))) \
+            if environ.get("SCRYPT_N") else None
+        self.credentials = CredentialVerifier(
+            self.users,
+            max_workers=int(environ.get("LOGIN_WORKERS", CredentialVerifier.max_workers)),
+            max_queue=int(environ.get("LOGIN_QUEUE", CredentialVerifier.max_queue)),
+            cost=cost)
+        self.tokens = TokenRegistry(
+            self.users.db_path,
+            flush_interval=float(environ.get("TOKENS_FLUSH_INTERVAL", TokenRegistry.flush_interval)),
+            shared=bool(self.shared_samples))
+        self.recorder = ReadingRecorder(
+            environ.get("READINGS_DB", "readings.db"),
+            batch_size=int(environ.get("READINGS_BATCH", ReadingRecorder.batch_size)),
+            flush_interval=float(environ.get("READINGS_FLUSH_INTERVAL", ReadingRecorder.flush_interval)))
+        self.broadcaster = Broadcaster(int(environ.get("STREAM_QUEUE_SIZE", Broadcaster.queue_size)))
+        self.stats = Stats()
+        self.recent: Dict[str, SampleStore] = {}
+        self.sensors: SensorRegistry | SharedSensors = None  # type: ignore
+        self.jwt: JSONToken = None  # type: ignore
+        self.scheduler: Scheduler = None  # type: ignore
+
+    def _open_sensors(self) -> SensorRegistry | SharedSensors:
+        if self.shared_samples:
+            try:
+                return SharedSensors.attach(self.shared_samples)
+            except FileNotFoundError:
+                raise RuntimeError(f"No shared memory '{self.shared_samples}', start the sensor daemon first")
+        return open_sensors()
+
+    def _open_users(self) -> None:
+        init_db(self.users.db_path)
+        # DEMO_PASSWORD adds a user (DEMO_USER, "demo" by default) if it does not exist yet
+        username, password = environ.get("DEMO_USER", "demo"), environ.get("DEMO_PASSWORD")
+        if password and not get_user(self.users, username):
+            add_demo_user(self.users, username, hash_password(password, *(self.credentials.cost or self.DEFAULT_COST)))
+
+    async def start(self) -> None:
+        self.sensors, self.jwt, _ = await gather(
+            to_thread(self._open_sensors),
+            to_thread(JSONToken, private_key_path="keys/private_key.pem", public_key_path="keys/pubkey.pem"),
+            to_thread(self._open_users))
+        if not self.shared_samples:
+            self.sensors.subscribe(self.recorder.record)
+        self.sensors.subscribe(self.broadcaster.publish)
+        self.sensors.subscribe(self.stats.record)
+        capacity = int(environ.get("RECENT_SAMPLES", SampleStore.capacity))
+        for name in self.sensors.sensors:
+            self.recent[name] = SampleStore(capacity)
+            self.sensors.get(name).subscribe(self.recent[name].add)
+        await self.tokens.start()
+        # with the daemon the recorder only serves the history from the database, which the
+        # daemon writes after every sweep
+        await self.recorder.start()
+        if isinstance(self.sensors, SharedSensors):
+            self.sensors.start()
+            return
+        self.scheduler = Scheduler(self.sensors, interval=float(environ.get("SAMPLE_INTERVAL", Scheduler.interval)))
+        if env_flag("CALIBRATE"):
+            self.sensors.start_calibration()
+        await self.scheduler.start()
+
+    async def stop(self) -> None:
+        if self.scheduler is not None:
+            await self.scheduler.stop()
+        await self.recorder.stop()
+        if self.sensors is not None:
+            self.sensors.close()
+        await self.tokens.stop()
+
+    async def check_token(self, authorization: str | None) -> str:
+        """
+        Verifies the bearer token from the Authorization header
+        :return: the token
+        :raises HTTPException: if the header is missing or the token does not verify
+        """
+        from jwcrypto.jws import InvalidJWSSignature, InvalidJWSObject, JWKeyNotFound, JWException  # type: ignore
+        if not authorization or len(authorization) < 1:
+            raise HTTPException(HTTP_401_UNAUTHORIZED)
+        try:
+            token_type, token = authorization.split(" ")
+            if token_type != "Bearer":
+                raise HTTPException(HTTP_400_BAD_REQUEST)
+            self.jwt.verify(token, self.jwt.public_key, self.jwt.cache)
+            if not await self.tokens.is_live(token):
+                raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+
+        except InvalidJWSSignature as e:
+            raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail=str(e))
+        except JWKeyNotFound:
+            raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR)
+        except JWException or InvalidJWSObject as e:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+        return token
+
+
+def get_services(conn: HTTPConnection) -> Services:
+    return conn.app.state.services
+
+
+router = APIRouter()
+
+BATCH_LIMIT = 32
+
+
+def check_reads(reads: int | None, delay: int | None) -> None:
+    """
+    :raises HTTPException: if the read count or the delay between reads is out of range
+    """
+    try:
+        if not reads or not delay:
+            raise ValueError("Required parameters missing")
+        if reads < 2 or reads > 4:
+            raise ValueError("Read count should be between 2 and 4")
+        if delay < 2 or delay > 5:
+            raise ValueError("Delay should be between 2 and 5 seconds")
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@router.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
-@app.post("/api/authorize", response_model=AuthResponse)
-async def authorize(authorization: str | None = Header(default=None)):
+@router.get("/metrics")
+async def get_metrics(authorization: str | None = Header(default=None),
+                      services: Services = Depends(get_services)):
+    await services.check_token(authorization)
+    return Response(content=REGISTRY.expose(), media_type=CONTENT_TYPE)
+
+
+@router.get("/api/cache")
+async def get_cache_stats(authorization: str | None = Header(default=None),
+                          services: Services = Depends(get_services)):
+    await services.check_token(authorization)
+    return {"token_cache": services.jwt.cache.stats()}
+
+
+@router.post("/api/authorize", response_model=AuthResponse)
+async def authorize(authorization: str | None = Header(default=None),
+                    services: Services = Depends(get_services)):
     if not authorization or len(authorization) < 1:
         raise HTTPException(HTTP_401_UNAUTHORIZED)
     r = AuthResponse()
@@ -104,10 +213,18 @@ async def authorize(authorization: str | None = Header(default=None)):
             authorization.lstrip("Basic")).decode("utf8").split(":")
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    if validate_credentials(username, password):
-        token = jwt.sign(payload={"app": "templogger"})
+    try:
+        valid = await services.credentials.validate(username, password)
+    except Overloaded as e:
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    if valid:
+        token = services.jwt.sign(payload={"app": "templogger", "sub": username})
         r.token_type = "Bearer"
         r.token = token.serialize(compact=True)
+        services.tokens.issue(username, r.token, token.jose_header["exp"])
+        if services.tokens.shared:
+            # the other workers look the token up in the table
+            await services.tokens.flush()
         return r
     else:
         r.code = HTTP_401_UNAUTHORIZED
@@ -115,60 +232,327 @@ async def authorize(authorization: str | None = Header(default=None)):
         raise HTTPException(status_code=r.code, detail=r.msg)
 
 
-@app.get("/api/getData", response_model=Union[
+@router.post("/api/revoke")
+async def revoke(authorization: str | None = Header(default=None),
+                 services: Services = Depends(get_services)):
+    services.tokens.revoke(await services.check_token(authorization))
+    if services.tokens.shared:
+        await services.tokens.flush()
+    return {"code": 200, "message": "Token revoked"}
+
+
+@router.get("/api/getData", response_model=Union[
     JSONDataResponse, HexDataResponse,
     Base64DataResponse, HumanDataResponse
 ])
 async def get_data(q: str = Query(default="all", max_length=4),
-                   reads: int | None = Query(default=2, max_length=1),
+                   reads: int | None = Query(default=2),
                    fmt: str | None = Query(
                        default="json", max_length=10, alias="format"),
-                   delay: int | None = Query(default=2, max_length=1),
-                   authorization: str | None = Header(default=None)):
-    if not authorization or len(authorization) < 1:
-        raise HTTPException(HTTP_401_UNAUTHORIZED)
+                   delay: int | None = Query(default=2),
+                   max_age: float | None = Query(default=None, ge=0),
+                   sensor: str | None = Query(default=None, max_length=32),
+                   authorization: str | None = Header(default=None),
+                   services: Services = Depends(get_services)):
+    await services.check_token(authorization)
     try:
-        token_type, token = authorization.split(" ")
-        if token_type != "Bearer":
-            raise HTTPException(HTTP_400_BAD_REQUEST)
-        jwt.verify(token, jwt.public_key)
-
-    except InvalidJWSSignature as e:
-        raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail=str(e))
-    except JWKeyNotFound:
-        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR)
-    except JWException or InvalidJWSObject as e:
-        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+        sampler = services.sensors.get(sensor)
+    except KeyError:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Unknown sensor '{sensor}'")
+
+    check_reads(reads, delay)
+    read_count = reads
+    if q not in QUANTITIES:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"q should be one of {', '.join(QUANTITIES)}")
+    if fmt not in DATA_FORMATS:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                            detail=f"format should be one of {', '.join(DATA_FORMATS)}")
 
+    # answered from the background sampler's cache, the bus is only touched if the
+    # cached sample is older than `max_age` seconds (or if there is no sample yet)
     try:
-        if not reads or not delay:
-            raise ValueError("Required parameters missing")
-        read_count = reads
-        delay = delay
-        if read_count < 2 or read_count > 4:
-            raise ValueError("Read count should be between 2 and 4")
-        if delay < 2 or delay > 5:
-            raise ValueError("Delay should be between 2 and 5 seconds")
-        dev.read_count = read_count
-        dev.delay = delay
-    except ValueError as e:
-        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
-    data = bytes(0)
-    if q == "all":
-        data = dev.get_all()
-        pass
-    elif q == "temp":
-        data = dev.get_temperature()
-        pass
-    elif q == "humi":
-        data = dev.get_humidity()
-        pass
-
-    results = {
+        sample = await sampler.get(max_age=max_age, read_count=read_count, delay=delay)
+    except (IOError, ValueError) as e:
+        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    record = sample.record or Record(sample.frame)
+
+    # rendered once per (sample, q, format, reads, delay, stale) and returned as bytes, so
+    # the response_model Union (kept for the docs) is not validated on every request
+    body = record.response(("response", q, fmt, read_count, delay, sample.stale), {
+        "sensor": sampler.name,
         "q": q,
         "reads": read_count,
         "format": fmt,
         "delay": delay,
-        "data": fmt_response(q, data, fmt)
+        "timestamp": sample.timestamp,
+        "stale": sample.stale,
+        "data": record.render(q, fmt)
+    })
+    return Response(content=body, media_type="application/json")
+
+
+@router.post("/api/getData/batch", response_model=BatchResponse)
+async def get_data_batch(batch: BatchRequest,
+                         authorization: str | None = Header(default=None),
+                         services: Services = Depends(get_services)):
+    """
+    Several (sensor, q, format) items in one request. Every sensor is read at most once:
+    a sample holds all four registers, which covers every `q`, and each item is rendered
+    from it. Sensors on different buses are read in parallel. A sensor that fails only
+    fails its own items, they get an `error` instead of `data`.
+    """
+    await services.check_token(authorization)
+    check_reads(batch.reads, batch.delay)
+    if not batch.items or len(batch.items) > BATCH_LIMIT:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"Between 1 and {BATCH_LIMIT} items")
+    for item in batch.items:
+        item.sensor = item.sensor or services.sensors.default
+        if item.sensor not in services.sensors.sensors:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Unknown sensor '{item.sensor}'")
+        if item.q not in QUANTITIES:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"q should be one of {', '.join(QUANTITIES)}")
+        if item.format not in DATA_FORMATS:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                                detail=f"format should be one of {', '.join(DATA_FORMATS)}")
+
+    names = list(dict.fromkeys(item.sensor for item in batch.items))
+    samples = await gather(*[services.sensors.get(name).get(max_age=batch.max_age, read_count=batch.reads,
+                                                            delay=batch.delay) for name in names],
+                           return_exceptions=True)
+    by_sensor = dict(zip(names, samples))
+
+    results: List[dict] = []
+    for item in batch.items:
+        sample = by_sensor[item.sensor]
+        result = {"sensor": item.sensor, "q": item.q, "format": item.format}
+        if isinstance(sample, (IOError, ValueError)):
+            results.append({**result, "timestamp": None, "stale": False, "data": None, "error": str(sample)})
+            continue
+        if isinstance(sample, BaseException):
+            raise sample
+        record = sample.record or Record(sample.frame)
+        results.append({**result, "timestamp": sample.timestamp, "stale": sample.stale,
+                        "data": record.render(item.q, item.format), "error": None})
+    body = dumps({"reads": batch.reads, "delay": batch.delay, "results": results},
+                 ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+    return Response(content=body.encode("utf-8"), media_type="application/json")
+
+
+@router.get("/api/history", response_model=HistoryResponse)
+async def get_history(ts_from: float = Query(alias="from"),
+                      ts_to: float | None = Query(default=None, alias="to"),
+                      sensor: str | None = Query(default=None, max_length=32),
+                      after: float | None = Query(default=None),
+                      limit: int = Query(default=500, ge=1, le=5000),
+                      authorization: str | None = Header(default=None),
+                      services: Services = Depends(get_services)):
+    await services.check_token(authorization)
+    sensor = sensor or services.sensors.default
+    if ts_to is None:
+        ts_to = time()
+    if ts_to < ts_from:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="'to' is before 'from'")
+
+    rows = await services.recorder.history(sensor, ts_from, ts_to, after, limit)
+    return {
+        "sensor": sensor,
+        "from": ts_from,
+        "to": ts_to,
+        "readings": [{"timestamp": r[0], "humi": r[1], "temp": r[2]} for r in rows],
+        # pass this as `after` to get the next page
+        "next": rows[-1][0] if len(rows) == limit else None
     }
-    return results
+
+
+@router.get("/api/stats")
+async def get_stats(sensor: str | None = Query(default=None, max_length=32),
+                    window: str | None = Query(default=None, max_length=4),
+                    authorization: str | None = Header(default=None),
+                    services: Services = Depends(get_services)):
+    await services.check_token(authorization)
+    sensor = sensor or services.sensors.default
+    if sensor not in services.sensors.sensors:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Unknown sensor '{sensor}'")
+    if window is not None and window not in services.stats.windows:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                            detail=f"window should be one of {', '.join(services.stats.windows)}")
+    try:
+        summary = services.stats.summary(sensor, window)
+    except KeyError:
+        # no samples yet
+        summary = {}
+    return {"sensor": sensor, **summary}
+
+
+@router.get("/api/recent")
+async def get_recent(sensor: str | None = Query(default=None, max_length=32),
+                     n: int | None = Query(default=None, ge=1),
+                     seconds: float | None = Query(default=None, gt=0),
+                     authorization: str | None = Header(default=None),
+                     services: Services = Depends(get_services)):
+    """
+    The last `n` samples or those from the last `seconds` seconds (the last 100 if neither
+    is given), from memory
+    """
+    await services.check_token(authorization)
+    sensor = sensor or services.sensors.default
+    store = services.recent.get(sensor)
+    if store is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Unknown sensor '{sensor}'")
+    samples = store.since(seconds) if seconds else store.last(n or 100)
+    if seconds and n:
+        samples = store.last(min(n, len(samples)))
+    return {"sensor": sensor, "count": len(samples), **samples.columns()}
+
+
+@router.websocket("/api/stream")
+async def stream_ws(websocket: WebSocket, sensor: str | None = None,
+                    services: Services = Depends(get_services)):
+    # browsers cannot set headers on a WebSocket, they pass the token as a subprotocol,
+    # new WebSocket(url, ["bearer", token]), which keeps it out of the logged URL
+    authorization = websocket.headers.get("authorization")
+    subprotocol = None
+    protocols = websocket.scope.get("subprotocols", [])
+    if authorization is None and len(protocols) == 2 and protocols[0] == "bearer":
+        authorization, subprotocol = f"Bearer {protocols[1]}", "bearer"
+    try:
+        await services.check_token(authorization)
+        if sensor is not None:
+            services.sensors.get(sensor)
+    except (HTTPException, KeyError):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept(subprotocol)
+    sub = services.broadcaster.subscribe(sensor)
+
+    async def send_events():
+        while True:
+            event = await sub.get()
+            await websocket.send_text(event.json)
+
+    async def wait_disconnect():
+        # the client never sends anything, receive() returns when it goes away
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [create_task(send_events()), create_task(wait_disconnect())]
+    try:
+        done, _ = await wait(tasks, return_when=FIRST_COMPLETED)
+        for t in done:
+            # a failed send (websockets.ConnectionClosed, WebSocketDisconnect, ...) is a disconnect too
+            if not t.cancelled() and t.exception() is not None:
+                services.broadcaster.log.debug(f"Stream client gone: {t.exception()!r}")
+    finally:
+        for t in tasks:
+            t.cancel()
+        services.broadcaster.unsubscribe(sub)
+
+
+@router.get("/api/stream")
+async def stream_sse(sensor: str | None = Query(default=None, max_length=32),
+                     authorization: str | None = Header(default=None),
+                     services: Services = Depends(get_services)):
+    await services.check_token(authorization)
+    if sensor is not None and sensor not in services.sensors.sensors:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Unknown sensor '{sensor}'")
+    sub = services.broadcaster.subscribe(sensor)
+
+    async def events():
+        try:
+            while True:
+                try:
+                    event = await wait_for(sub.get(), 15)
+                    yield event.sse
+                except TimeoutError:
+                    # keeps proxies from closing an idle connection
+                    yield b": ping\n\n"
+        finally:
+            services.broadcaster.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"cache-control": "no-cache", "x-accel-buffering": "no"})
+
+
+@router.get("/api/export")
+async def export_readings(ts_from: float = Query(default=0, alias="from"),
+                          ts_to: float | None = Query(default=None, alias="to"),
+                          sensor: str | None = Query(default=None, max_length=32),
+                          fmt: str = Query(default="ndjson", max_length=10, alias="format"),
+                          q: str = Query(default="all", max_length=4),
+                          compress: str | None = Query(default=None, max_length=4),
+                          authorization: str | None = Header(default=None),
+                          services: Services = Depends(get_services)):
+    await services.check_token(authorization)
+    sensor = sensor or services.sensors.default
+    if sensor not in services.sensors.sensors:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"Unknown sensor '{sensor}'")
+    if q not in QUANTITIES:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"q should be one of {', '.join(QUANTITIES)}")
+    if ts_to is None:
+        ts_to = time()
+    if compress not in [None, "gzip"]:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="compress should be 'gzip' if given")
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"format should be one of {', '.join(FORMATS)}")
+
+    # whatever is still waiting for the next batch goes to disk first (nothing with the
+    # daemon, it writes every sweep)
+    await services.recorder.flush()
+    # a sync generator, starlette advances it in the threadpool
+    body = export(iter_readings(services.recorder.db_path, sensor, ts_from, ts_to), sensor, fmt, q,
+                  compress == "gzip")
+    ext = {"json": "json", "hex": "json", "base64": "json", "human": "json", "binary": "bin"}.get(fmt, fmt)
+    filename = f"{sensor}-{int(ts_from)}-{int(ts_to)}.{ext}" + (".gz" if compress else "")
+    return StreamingResponse(body, media_type="application/gzip" if compress else media_type(fmt),
+                             headers={"content-disposition": f'attachment; filename="{filename}"'})
+
+
+@router.get("/api/traces")
+async def get_traces(sensor: str | None = Query(default=None, max_length=32),
+                     limit: int | None = Query(default=None, ge=1),
+                     authorization: str | None = Header(default=None),
+                     services: Services = Depends(get_services)):
+    await services.check_token(authorization)
+    if isinstance(services.sensors, SharedSensors):
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Traces are kept by the sensor daemon")
+    try:
+        s = services.sensors.sensors[sensor or services.sensors.default]
+    except KeyError:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Unknown sensor '{sensor}'")
+    return {"sensor": s.name, "summary": s.traces.summary(), "timing": s.timing.as_dict(),
+            "traces": s.traces.dump(limit)}
+
+
+def uncompressed(scope) -> bool:
+    """
+    Responses the gzip middleware must leave alone: event streams, which it would hold back,
+    and exports the app compresses itself (?compress=gzip), which it would compress again
+    """
+    path = scope["path"]
+    return path == "/api/stream" or (path == "/api/export" and "compress" in parse_qs(scope["query_string"].decode()))
+
+
+def create_app() -> FastAPI:
+    """
+    Builds the app without touching the hardware, the keys or the databases, those are
+    opened by the startup event. Run with `uvicorn main:app` or `uvicorn --factory main:create_app`.
+    """
+    load_dotenv()
+    configure_logging()
+    services = Services()
+    middlewares = [
+        Middleware(cors.CORSMiddleware,
+                   allow_origins=["https://logger.sokru.fi"],
+                   allow_methods=["GET", "POST", "HEAD"]),
+        Middleware(SelectiveGZipMiddleware, skip=uncompressed, compresslevel=6),
+        Middleware(trustedhost.TrustedHostMiddleware,
+                   allowed_hosts=["logger.sokru.fi"]),
+        Middleware(SecurityMiddleware, debug_sample_rate=float(environ.get("DEBUG_HEADERS_SAMPLE", 0)))
+    ]
+    app = FastAPI(middleware=middlewares, on_startup=[services.start], on_shutdown=[services.stop])
+    app.state.services = services
+    app.include_router(router)
+    return app
+
+
+app = create_app()
@@ -0,0 +1,227 @@
+from bisect import bisect_left
+from threading import Lock, local
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, TypeVar
+
+# seconds, from the ~100 us of a cached token check up to multi-second sensor cycles
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                                      0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+M = TypeVar("M", bound="Metric")
+
+
+class _Cells:
+    """
+    Per-thread accumulation. Every thread that updates a metric gets its own list that
+    only it writes to, so an update is a thread-local lookup and an in-place add, no lock.
+    The lock is taken once per thread, to register its list. Collection sums all lists,
+    it may miss an update that is in progress, which is fine for monitoring.
+    """
+    __slots__ = ("size", "local", "_all", "_lock")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.local = local()
+        self._all: List[list] = []
+        self._lock = Lock()
+
+    def cell(self) -> list:
+        try:
+            return self.local.cell
+        except AttributeError:
+            c = self.local.cell = [0] * self.size
+            with self._lock:
+                self._all.append(c)
+            return c
+
+    def sum(self) -> list:
+        total = [0] * self.size
+        with self._lock:
+            cells = list(self._all)
+        for c in cells:
+            for i, v in enumerate(c):
+                total[i] += v
+        return total
+
+
+class Metric:
+    type: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), labelvalues: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.labelvalues = labelvalues
+        self._children: Dict[tuple, "Metric"] = {}
+        self._lock = Lock()
+
+    def _new_child(self: M, labelvalues: tuple) -> M:
+        return type(self)(self.name, self.documentation, self.labelnames, labelvalues)
+
+    def labels(self: M, *labelvalues) -> M:
+        """
+        The child for these label values. Look it up once and keep it on hot paths.
+        """
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        key = tuple(str(v) for v in labelvalues)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child(key))
+        return child  # type: ignore
+
+    def _label_str(self, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = tuple(zip(self.labelnames, self.labelvalues)) + extra
+        if not pairs:
+            return ""
+        escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def _samples(self) -> Iterator[str]:
+        return iter(())
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        if self.labelnames:
+            for child in list(self._children.values()):
+                yield from child._samples()
+        else:
+            yield from self._samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cells = _Cells(1)
+        self._local = self._cells.local
+
+    def inc(self, amount: float = 1) -> None:
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._cells.cell()[0] += amount
+
+    @property
+    def value(self) -> float:
+        return self._cells.sum()[0]
+
+    def _samples(self) -> Iterator[str]:
+        yield f"{self.name}{self._label_str()} {self.value}"
+
+
+class Gauge(Metric):
+    """
+    Either set() explicitly or backed by a callback that is read at collection time
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), labelvalues: tuple = (),
+                 fn: Callable[[], float] = None):
+        super().__init__(name, documentation, labelnames, labelvalues)
+        self._value = 0.0
+        self._fn = fn
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        self._fn = fn
+
+    @property
+    def value(self) -> float:
+        return self._fn() if self._fn else self._value
+
+    def _samples(self) -> Iterator[str]:
+        yield f"{self.name}{self._label_str()} {self.value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), labelvalues: tuple = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, labelvalues)
+        self.buckets = tuple(sorted(buckets))
+        # one count per bucket, one for +Inf, then the sum
+        self._cells = _Cells(len(self.buckets) + 2)
+        self._local = self._cells.local
+
+    def _new_child(self, labelvalues: tuple) -> "Histogram":
+        return Histogram(self.name, self.documentation, self.labelnames, labelvalues, self.buckets)
+
+    def observe(self, value: float) -> None:
+        try:
+            c = self._local.cell
+        except AttributeError:
+            c = self._cells.cell()
+        c[bisect_left(self.buckets, value)] += 1
+        c[-1] += value
+
+    def time(self) -> "_Timer":
+        """
+        with histogram.time(): ...
+        """
+        return _Timer(self)
+
+    def _samples(self) -> Iterator[str]:
+        counts = self._cells.sum()
+        total = 0
+        for le, n in zip(self.buckets, counts):
+            total += n
+            yield f"{self.name}_bucket{self._label_str((('le', repr(float(le))),))} {total}"
+        total += counts[-2]
+        yield f"{self.name}_bucket{self._label_str((('le', '+Inf'),))} {total}"
+        yield f"{self.name}_sum{self._label_str()} {counts[-1]}"
+        yield f"{self.name}_count{self._label_str()} {total}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            # module reloads and repeated setup get the existing metric back
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))  # type: ignore
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              fn: Callable[[], float] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, fn=fn))  # type: ignore
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))  # type: ignore
+
+    def expose(self) -> str:
+        """
+        All metrics in the Prometheus text format (version 0.0.4)
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for m in metrics for line in m.expose()) + "\n"
+
+
+REGISTRY = Registry()
+# starlette appends "; charset=utf-8" to text/ media types
+CONTENT_TYPE = "text/plain; version=0.0.4"
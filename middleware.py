@@ -0,0 +1,130 @@
+from logging import DEBUG, Logger, getLogger
+from random import random
+from time import perf_counter
+from typing import Callable, List, Tuple
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from metrics import REGISTRY
+
+Headers = List[Tuple[bytes, bytes]]
+
+SECURITY_HEADERS: Headers = [
+    (b"strict-transport-security", b"max-age=63072000; includeSubDomains; preload"),
+    (b"x-frame-options", b"DENY"),
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-xss-protection", b"1; mode=block")
+]
+
+UNAUTHORIZED_BODY: bytes = b'{"code":401,"message":"Unauthorized"}'
+UNAUTHORIZED_START: Message = {
+    "type": "http.response.start",
+    "status": 401,
+    "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(UNAUTHORIZED_BODY)).encode())
+    ] + SECURITY_HEADERS
+}
+UNAUTHORIZED_END: Message = {"type": "http.response.body", "body": UNAUTHORIZED_BODY}
+# policy violation, sent instead of accepting a WebSocket
+WS_UNAUTHORIZED: Message = {"type": "websocket.close", "code": 1008}
+
+METHODS = {"GET", "POST", "HEAD", "OPTIONS", "PUT", "DELETE", "PATCH"}
+REQUEST_TIME = REGISTRY.histogram("http_request_duration_seconds",
+                                  "Time from receiving a request to the end of its response", ["method"])
+REQUESTS = REGISTRY.counter("http_requests_total", "Finished requests", ["method", "status"])
+
+
+class SecurityMiddleware:
+    """
+    Pure ASGI middleware.
+    Rejects requests and WebSockets that did not come through the nginx proxy (x-nginx-proxy:
+    true and matching x-real-ip / x-forwarded-for) and adds the security headers to every
+    response.
+
+    Header dumping is off unless the logger is at DEBUG and `debug_sample_rate` > 0, then
+    that fraction of requests gets its request and response headers logged.
+    """
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, app: ASGIApp, debug_sample_rate: float = 0.0):
+        self.app = app
+        self.debug_sample_rate = debug_sample_rate
+        self.in_flight = 0
+        REGISTRY.gauge("http_requests_in_flight", "Requests being handled").set_function(lambda: self.in_flight)
+
+    def _dump(self, prefix: str, headers: Headers) -> None:
+        self.log.debug(prefix + " ".join(f"'{k.decode()}: {v.decode()}'" for k, v in headers))
+
+    @staticmethod
+    def _proxied(scope: Scope) -> bool:
+        real_ip = forwarded_for = proxy = None
+        for k, v in scope["headers"]:
+            if k == b"x-real-ip":
+                real_ip = v
+            elif k == b"x-forwarded-for":
+                forwarded_for = v
+            elif k == b"x-nginx-proxy":
+                proxy = v
+        return real_ip == forwarded_for and proxy == b"true"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "websocket":
+            if self._proxied(scope):
+                await self.app(scope, receive, send)
+            else:
+                await send(WS_UNAUTHORIZED)
+            return
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = perf_counter()
+        method = scope["method"] if scope["method"] in METHODS else "other"
+        if not self._proxied(scope):
+            await send(UNAUTHORIZED_START)
+            await send(UNAUTHORIZED_END)
+            REQUESTS.labels(method, 401).inc()
+            return
+
+        dump = self.debug_sample_rate > 0 and self.log.isEnabledFor(DEBUG) and random() < self.debug_sample_rate
+        if dump:
+            self._dump("<<< ", scope["headers"])
+
+        status = 500
+
+        async def send_with_headers(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", ())) + SECURITY_HEADERS
+                if dump:
+                    self._dump(f">>> {status} ", message["headers"])
+            await send(message)
+
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            self.in_flight -= 1
+            REQUEST_TIME.labels(method).observe(perf_counter() - started)
+            REQUESTS.labels(method, status).inc()
+
+
+class SelectiveGZipMiddleware:
+    """
+    Starlette's GZipMiddleware, except for requests `skip` matches. It buffers streamed
+    responses in its GzipFile without flushing, so an event stream would only deliver the
+    gzip header, and a body the app already compressed would be compressed twice.
+    """
+
+    def __init__(self, app: ASGIApp, skip: Callable[[Scope], bool], minimum_size: int = 500,
+                 compresslevel: int = 9):
+        self.app = app
+        self.skip = skip
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and not self.skip(scope):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, BaseConfig
-from typing import Dict
+from typing import Dict, List
 
 
 class AuthResponse(BaseModel):
@@ -20,10 +20,13 @@ class AuthResponse(BaseModel):
 
 
 class DataResponseBase(BaseModel):
+    sensor: str | None
     q: str
     reads: int | None = 2
     format: str
     delay: int | None = 2
+    timestamp: float | None
+    stale: bool = False
     data: Dict[str, float] | str | None
 
 
@@ -92,3 +95,89 @@ class HumanDataResponse(DataResponseBase):
                 "data": "RH %: 39.3, °C: 24.2"
             }
         }
+
+
+class HistoryReading(BaseModel):
+    timestamp: float
+    humi: float
+    temp: float
+
+
+class HistoryResponse(BaseModel):
+    sensor: str
+    ts_from: float
+    ts_to: float
+    readings: List[HistoryReading]
+    next: float | None
+
+    class Config(BaseConfig):
+        fields = {"ts_from": "from", "ts_to": "to"}
+        allow_population_by_field_name = True
+        schema_extra = {
+            "example": {
+                "sensor": "am2320",
+                "from": 1665000000.0,
+                "to": 1665000060.0,
+                "readings": [
+                    {"timestamp": 1665000010.2, "humi": 39.2, "temp": 24.1},
+                    {"timestamp": 1665000020.2, "humi": 39.3, "temp": 24.1}
+                ],
+                "next": None
+            }
+        }
+
+
+class BatchItem(BaseModel):
+    sensor: str | None
+    q: str = "all"
+    format: str = "json"
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    reads: int = 2
+    delay: int = 2
+    max_age: float | None
+
+    class Config(BaseConfig):
+        schema_extra = {
+            "example": {
+                "items": [
+                    {"sensor": "am2320", "q": "all", "format": "json"},
+                    {"sensor": "am2320", "q": "all", "format": "base64"}
+                ],
+                "reads": 2,
+                "delay": 2,
+                "max_age": 10
+            }
+        }
+
+
+class BatchResult(BaseModel):
+    sensor: str
+    q: str
+    format: str
+    timestamp: float | None
+    stale: bool = False
+    data: Dict[str, float] | str | None
+    error: str | None
+
+
+class BatchResponse(BaseModel):
+    reads: int
+    delay: int
+    results: List[BatchResult]
+
+    class Config(BaseConfig):
+        schema_extra = {
+            "example": {
+                "reads": 2,
+                "delay": 2,
+                "results": [
+                    {"sensor": "am2320", "q": "all", "format": "json", "timestamp": 1665000010.2,
+                     "stale": False, "data": {"humi": 39.2, "temp": 24.1}},
+                    {"sensor": "am2320", "q": "all", "format": "base64", "timestamp": 1665000010.2,
+                     "stale": False, "data": "AwQBiwDyAbs="}
+                ]
+            }
+        }
@@ -0,0 +1,174 @@
+from asyncio import Task, CancelledError, create_task, sleep
+from logging import Logger, getLogger
+from time import monotonic, time
+from typing import Callable, List, NamedTuple
+from AsyncAM2320 import AsyncAM2320, Reading
+from crc import frame_ok
+from metrics import REGISTRY
+from utils import Record
+
+CIRCUIT_OPEN = REGISTRY.gauge("am2320_circuit_open", "1 while reads of the sensor are suspended", ["sensor"])
+
+
+class Sample(NamedTuple):
+    sensor: str
+    frame: bytes        # validated `get_all()` frame: [0x03, 0x04, humi_hi, humi_lo, temp_hi, temp_lo, crc_lo, crc_hi]
+    timestamp: float    # unix time of the read
+    monotonic: float    # time.monotonic() of the read, used for age checks
+    crc_retries: int = 0
+    record: Record | None = None    # decoded frame, see utils.Record
+    stale: bool = False             # the last good sample, served while the sensor is failing
+
+
+class Sampler:
+    """
+    Polls the sensor in the background and keeps the latest validated frame in memory,
+    so request handlers can answer without touching the bus.
+
+    Circuit breaker: after `failure_threshold` failed refreshes in a row the sensor is
+    left alone, refresh() returns the last good sample with `stale` set (or raises
+    IOError if there never was one), and a background task tries a read every
+    `probe_interval` seconds. The first one that succeeds closes the breaker.
+    """
+    name: str = "am2320"
+    interval: float = 10
+    read_count: int = 2
+    delay: int = 2
+    failure_threshold: int = 3
+    probe_interval: float = 30
+    sample: Sample | None = None
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, dev: AsyncAM2320, interval: float = None, name: str = None):
+        self.dev = dev
+        if interval:
+            self.interval = interval
+        if name:
+            self.name = name
+        self._task: Task | None = None
+        self._listeners: List[Callable[[Sample], None]] = []
+        self._last_reading: Reading | None = None
+        self.failures = 0
+        self._probe: Task | None = None
+        self._circuit_open = CIRCUIT_OPEN.labels(self.name)
+
+    def subscribe(self, listener: Callable[[Sample], None]) -> None:
+        """
+        Register a callback that is called with every new sample. Runs on the event loop,
+        so it must not block.
+        """
+        self._listeners.append(listener)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self.log.info(f"Starting sampler, interval {self.interval} s")
+            self._task = create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except CancelledError:
+                pass
+            self._task = None
+        self.close()
+
+    def close(self) -> None:
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except (IOError, ValueError) as e:
+                self.log.error(f"Background sample failed: {e!r}")
+            await sleep(self.interval)
+
+    def _validate(self, frame: bytes | None) -> bytes:
+        if not frame or len(frame) != 8 or frame[0] != 0x03 or frame[1] != 0x04:
+            raise ValueError(f"Malformed frame: {frame!r}")
+        if not frame_ok(frame):
+            raise ValueError(f"CRC mismatch in frame {frame.hex()}")
+        return bytes(frame)
+
+    async def refresh(self, read_count: int = None, delay: int = None, max_age: float = None) -> Sample:
+        """
+        Read the sensor now and store the result as the latest sample.
+        :param read_count: how many consecutive reads to do (defaults to `self.read_count`)
+        :param delay: seconds between the reads (defaults to `self.delay`)
+        :param max_age: if a sample younger than this is already stored, return it instead
+        :return: the new sample, or the last good one flagged `stale` while the breaker is open
+        """
+        if max_age is not None and self.sample and monotonic() - self.sample.monotonic <= max_age:
+            return self.sample
+        if self.is_open:
+            return self._stale()
+        try:
+            sample = await self._read(read_count or self.read_count, delay or self.delay)
+        except (IOError, ValueError) as e:
+            self.failures += 1
+            if self.failures < self.failure_threshold:
+                raise
+            self._open(e)
+            return self._stale()
+        self.failures = 0
+        return sample
+
+    @property
+    def is_open(self) -> bool:
+        return self._probe is not None
+
+    def _stale(self) -> Sample:
+        if self.sample is None:
+            raise IOError(f"Sensor '{self.name}' is unavailable")
+        return self.sample._replace(stale=True)
+
+    def _open(self, e: BaseException) -> None:
+        self.log.error(f"Suspending reads of sensor '{self.name}' after {self.failures} failures: {e!r}")
+        self._circuit_open.set(1)
+        self._probe = create_task(self._probe_until_ok())
+
+    async def _probe_until_ok(self) -> None:
+        while True:
+            await sleep(self.probe_interval)
+            try:
+                await self._read(self.read_count, self.delay)
+            except (IOError, ValueError) as e:
+                self.log.debug(f"Probe of sensor '{self.name}' failed: {e!r}")
+                continue
+            self.log.info(f"Sensor '{self.name}' is back, resuming reads")
+            self.failures = 0
+            self._circuit_open.set(0)
+            self._probe = None
+            return
+
+    async def _read(self, read_count: int, delay: int) -> Sample:
+        # concurrent refreshes with the same parameters share one bus transaction in the driver
+        reading = await self.dev.read(0x00, 0x04, read_count, delay)
+        if reading is self._last_reading:
+            # joined a read another refresh() started, that one already stored it
+            return self.sample  # type: ignore
+        frame = self._validate(reading.frame)
+        sample = Sample(self.name, frame, time(), monotonic(), reading.crc_retries, Record(frame))
+        self._last_reading = reading
+        if self.sample is None or sample.monotonic > self.sample.monotonic:
+            self.sample = sample
+            for listener in self._listeners:
+                try:
+                    listener(sample)
+                except Exception as e:
+                    self.log.error(f"Sample listener {listener!r} failed: {e!r}")
+        return sample
+
+    async def get(self, max_age: float = None, read_count: int = None, delay: int = None) -> Sample:
+        """
+        Return the latest sample, reading the sensor only if there is none yet
+        or if it is older than `max_age` seconds.
+        """
+        sample = self.sample
+        if sample is None or (max_age is not None and monotonic() - sample.monotonic > max_age):
+            return await self.refresh(read_count, delay, max_age)
+        return sample
@@ -0,0 +1,249 @@
+from asyncio import Lock, Task, CancelledError, create_task, gather, get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+from json import load
+from logging import Logger, getLogger
+from os import environ, path
+from time import monotonic
+from typing import Callable, Dict, List, NamedTuple
+from AM2320 import AM2320
+from AsyncAM2320 import AsyncAM2320
+from bases.I2CBusBase import I2CBusBase
+from calibration import AdaptiveTiming, Calibrator, DATASHEET, Timing, load_timings, save_timing
+from i2c import LinuxI2CBus, MuxedI2CBus
+from sampler import Sample, Sampler
+from simulator import SimulatedAM2320Bus
+from tracing import TraceRecorder
+from utils import env_flag
+
+
+class Sensor(NamedTuple):
+    name: str
+    bus: str
+    driver: AsyncAM2320
+    sampler: Sampler
+    traces: TraceRecorder
+    timing: AdaptiveTiming
+
+
+class SensorRegistry:
+    """
+    All configured sensors. The AM2320 has a fixed address, so every sensor is on its
+    own bus or on its own channel of an I2C mux. Drivers on the same bus share one
+    worker thread and one bus lock, drivers on different buses share nothing.
+
+    Config file (JSON):
+        {"sensors": [
+            {"name": "indoor", "bus": "/dev/i2c-1", "mux": {"addr": 112, "channel": 1}},
+            {"name": "outdoor", "bus": "/dev/i2c-1", "mux": {"addr": 112, "channel": 2}},
+            {"name": "test", "bus": "sim", "sim": {"temperature": -5.0}}
+        ]}
+    A bus starting with "sim" uses `simulator.SimulatedAM2320Bus`, "sim" takes its arguments.
+
+    Wakeup and settle delays come from `calibration_file` (see calibration.py) when the
+    sensor has been calibrated, the datasheet values otherwise, and back off on errors.
+    """
+    DEFAULT_CONFIG: List[dict] = [{"name": Sampler.name, "bus": AM2320.I2C_BUS}]
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, config: List[dict], loglevel: str = None, trace_size: int = None,
+                 calibration_file: str = None, fast_read: bool = None):
+        """
+        :param calibration_file: where calibrated timings are loaded from and saved to
+        :param fast_read: single reads while a sensor is awake, see `AsyncAM2320`
+        """
+        if not config:
+            raise ValueError("No sensors configured")
+        self.sensors: Dict[str, Sensor] = {}
+        self._buses: Dict[str, tuple] = {}
+        self._muxes: Dict[tuple, I2CBusBase] = {}
+        self.calibration_file = calibration_file
+        self._calibration: Task | None = None
+        timings = load_timings(calibration_file) if calibration_file else {}
+        self._check_muxes(config)
+        for c in config:
+            name = c["name"]
+            if name in self.sensors:
+                raise ValueError(f"Duplicate sensor name '{name}'")
+            executor, lock = self._bus(c["bus"])
+            dev = AM2320(bus=c["bus"], loglevel=loglevel, i2c=self._i2c(c))
+            driver = AsyncAM2320(dev, executor=executor, lock=lock, fast_read=fast_read)
+            traces = TraceRecorder(trace_size)
+            timing = AdaptiveTiming(dev, timings.get(name, DATASHEET))
+            dev.add_trace_hook(traces)
+            dev.add_trace_hook(timing)
+            self.sensors[name] = Sensor(name, c["bus"], driver, Sampler(driver, name=name), traces, timing)
+        self.default: str = config[0]["name"]
+
+    @classmethod
+    def from_file(cls, config_path: str, loglevel: str = None, backend: str = None,
+                  trace_size: int = None, calibration_file: str = None,
+                  fast_read: bool = None) -> "SensorRegistry":
+        """
+        Loads the registry from `config_path`, or a single sensor on /dev/i2c-1 if it does not exist
+        :param backend: "sim" to put the default sensor on the simulator
+        """
+        if path.exists(config_path):
+            with open(config_path) as f:
+                config = load(f)["sensors"]
+        else:
+            config = [dict(c) for c in cls.DEFAULT_CONFIG]
+            if backend == "sim":
+                config[0]["bus"] = "sim"
+        return cls(config, loglevel, trace_size, calibration_file, fast_read)
+
+    @staticmethod
+    def _check_muxes(config: List[dict]) -> None:
+        """
+        :raises ValueError: if a bus has sensors both directly on it and behind a mux, or behind
+            more than one mux. They all answer at 0x5c, and a mux channel stays selected after
+            a muxed transaction, so the sensor behind it would answer the transactions meant
+            for the direct sensor or for the one behind the other mux too.
+        """
+        direct = {c["bus"] for c in config if not c.get("mux")}
+        muxes: Dict[str, set] = {}
+        for c in config:
+            if c.get("mux"):
+                muxes.setdefault(c["bus"], set()).add(c["mux"].get("addr", 0x70))
+        mixed = direct & set(muxes)
+        if mixed:
+            raise ValueError(f"Bus '{min(mixed)}' has sensors both behind a mux and directly on it, "
+                             f"put the direct ones on a mux channel of their own")
+        for bus, addrs in sorted(muxes.items()):
+            if len(addrs) > 1:
+                raise ValueError(f"Bus '{bus}' has sensors behind {len(addrs)} muxes, "
+                                 f"put them all behind one mux or on separate buses")
+
+    def _bus(self, bus: str) -> tuple:
+        if bus not in self._buses:
+            self._buses[bus] = (ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"i2c-{len(self._buses)}"),
+                                Lock())
+        return self._buses[bus]
+
+    def _i2c(self, c: dict) -> I2CBusBase:
+        if c["bus"].startswith("sim"):
+            return SimulatedAM2320Bus(path=c["bus"], **c.get("sim", {}))
+        device = LinuxI2CBus(c["bus"], AM2320.I2C_ADDR)
+        mux = c.get("mux")
+        if not mux:
+            return device
+        key = (c["bus"], mux.get("addr", 0x70))
+        if key not in self._muxes:
+            self._muxes[key] = LinuxI2CBus(c["bus"], key[1])
+        return MuxedI2CBus(device, self._muxes[key], mux["channel"])
+
+    def get(self, name: str | None = None) -> Sampler:
+        """
+        :raises KeyError: if there is no such sensor
+        """
+        return self.sensors[name or self.default].sampler
+
+    @property
+    def samplers(self) -> List[Sampler]:
+        return [s.sampler for s in self.sensors.values()]
+
+    @property
+    def buses(self) -> List[str]:
+        return list(self._buses)
+
+    def subscribe(self, listener: Callable[[Sample], None]) -> None:
+        for s in self.samplers:
+            s.subscribe(listener)
+
+    async def calibrate(self, name: str) -> Timing:
+        """
+        Calibrate one sensor, holding its bus for the whole run (about a minute), then
+        use and save the result.
+        """
+        s = self.sensors[name]
+        async with s.driver.lock:
+            timing = await get_running_loop().run_in_executor(s.driver.executor, Calibrator(s.driver.dev).run)
+        s.timing.reset(timing)
+        if self.calibration_file:
+            save_timing(self.calibration_file, name, timing)
+        return timing
+
+    async def _calibrate_missing(self) -> None:
+        calibrated = load_timings(self.calibration_file) if self.calibration_file else {}
+        for name in self.sensors:
+            if name in calibrated:
+                continue
+            try:
+                await self.calibrate(name)
+            except OSError as e:
+                self.log.error(f"Calibrating sensor '{name}' failed, keeping the datasheet timing: {e!r}")
+
+    def start_calibration(self) -> None:
+        """
+        Calibrate every sensor that has no saved timing, one after another in the background
+        """
+        if self._calibration is None or self._calibration.done():
+            self._calibration = create_task(self._calibrate_missing())
+
+    def close(self) -> None:
+        if self._calibration is not None:
+            self._calibration.cancel()
+        for s in self.sensors.values():
+            s.sampler.close()
+            s.driver.dev.i2c.close()
+        for executor, _ in self._buses.values():
+            executor.shutdown(wait=False)
+
+
+def open_sensors(loglevel: str = "INFO") -> SensorRegistry:
+    """
+    The registry configured from the environment: SENSORS_CONFIG, SENSOR_BACKEND,
+    TRACE_BUFFER, CALIBRATION_FILE and FAST_READ. Without a config file one sensor on
+    /dev/i2c-1, or on the simulator with SENSOR_BACKEND=sim.
+    """
+    return SensorRegistry.from_file(environ.get("SENSORS_CONFIG", "sensors.json"),
+                                    loglevel=loglevel, backend=environ.get("SENSOR_BACKEND"),
+                                    trace_size=int(environ.get("TRACE_BUFFER", TraceRecorder.size)),
+                                    calibration_file=environ.get("CALIBRATION_FILE", "calibration.json"),
+                                    fast_read=env_flag("FAST_READ"))
+
+
+class Scheduler:
+    """
+    Polls every sensor once per `interval`. All sensors are started at once: the bus lock
+    serializes the wakeup/request/read cycles on each bus, while the waits between reads
+    and the cycles on other buses run in parallel. A sweep over N sensors therefore takes
+    about the time of one sensor plus a few ms per extra sensor on the busiest bus.
+    """
+    interval: float = 10
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, registry: SensorRegistry, interval: float = None):
+        self.registry = registry
+        if interval:
+            self.interval = interval
+        self._task: Task | None = None
+
+    async def sweep(self) -> Dict[str, Sample | BaseException]:
+        started = monotonic()
+        samplers = self.registry.samplers
+        results = await gather(*[s.refresh() for s in samplers], return_exceptions=True)
+        for s, r in zip(samplers, results):
+            if isinstance(r, BaseException):
+                self.log.error(f"Reading sensor '{s.name}' failed: {r!r}")
+        self.log.debug(f"Sweep over {len(samplers)} sensors took {monotonic() - started:.3f} s")
+        return {s.name: r for s, r in zip(samplers, results)}
+
+    async def _run(self) -> None:
+        while True:
+            await self.sweep()
+            await sleep(self.interval)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self.log.info(f"Polling {len(self.registry.sensors)} sensors on {len(self.registry.buses)} buses "
+                          f"every {self.interval} s")
+            self._task = create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,268 @@
+from asyncio import Task, create_task, sleep
+from logging import Logger, getLogger
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from os import getpid
+from struct import Struct
+from time import monotonic
+from typing import Callable, Dict, List, Sequence, Tuple
+from crc import frame_ok
+from sampler import Sample
+from utils import Record
+
+MAGIC = b"AMSB"
+VERSION = 1
+# magic, version, slot count, daemon pid, sample interval, monotonic time of the last sweep
+HEADER = Struct("=4sHHIdd")
+HEADER_SIZE = 32
+SEQ = Struct("=Q")
+# name, frame, unix time, monotonic time, crc retries, stale
+SLOT = Struct("=32s8sddHB")
+SLOT_SIZE = 80
+NAME_SIZE = 32
+
+
+class TornRead(Exception):
+    """
+    A slot kept changing while it was read, see `SampleBoard.read`
+    """
+
+
+class SampleBoard:
+    """
+    The latest sample of every sensor in a `multiprocessing.shared_memory` segment: one
+    writer (the sensor daemon, see daemon.py) and any number of readers (the API workers).
+
+    Each slot is guarded by a seqlock. The writer makes the sequence number odd, writes
+    the slot and makes it even again. A reader copies the slot between two reads of the
+    sequence number and retries when they differ or are odd, so neither side ever waits
+    for the other and a reader cannot stall the daemon. CPython has no memory fences,
+    each write is a separate C call, and readers also check the CRC of the frame.
+
+    The header carries the pid of the daemon and the monotonic time of its last sweep,
+    CLOCK_MONOTONIC is system wide, so readers can tell when the daemon has stopped.
+    """
+    retries: int = 100
+
+    def __init__(self, shm: SharedMemory, owner: bool = False):
+        self.shm = shm
+        self.owner = owner
+        self.buf = shm.buf
+        magic, version, count, self.pid, self.interval, _ = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Shared memory '{shm.name}' does not hold samples of this version")
+        self.names: List[str] = [self._name(i) for i in range(count)]
+        self.slots: Dict[str, int] = {name: HEADER_SIZE + i * SLOT_SIZE for i, name in enumerate(self.names)}
+
+    @classmethod
+    def create(cls, name: str, sensors: Sequence[str], interval: float) -> "SampleBoard":
+        """
+        A new segment for `sensors`, replacing one a daemon that crashed left behind
+        """
+        size = HEADER_SIZE + len(sensors) * SLOT_SIZE
+        try:
+            shm = SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            old = SharedMemory(name)
+            old.close()
+            old.unlink()
+            shm = SharedMemory(name, create=True, size=size)
+        shm.buf[:size] = bytes(size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, len(sensors), getpid(), interval, monotonic())
+        for i, sensor in enumerate(sensors):
+            encoded = sensor.encode()
+            if len(encoded) > NAME_SIZE:
+                raise ValueError(f"Sensor name '{sensor}' is longer than {NAME_SIZE} bytes")
+            SLOT.pack_into(shm.buf, HEADER_SIZE + i * SLOT_SIZE + SEQ.size, encoded, bytes(8), 0, 0, 0, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SampleBoard":
+        """
+        :raises FileNotFoundError: if the daemon is not running
+        """
+        try:
+            shm = SharedMemory(name, track=False)   # type: ignore[call-arg]
+        except TypeError:
+            # before Python 3.13 the resource tracker of a reader would unlink the segment when
+            # the reader exits, and take it away from the daemon and the other workers
+            shm = SharedMemory(name)
+            resource_tracker.unregister(shm._name, "shared_memory")     # type: ignore[attr-defined]
+        return cls(shm)
+
+    def _name(self, i: int) -> str:
+        offset = HEADER_SIZE + i * SLOT_SIZE + SEQ.size
+        return bytes(self.buf[offset:offset + NAME_SIZE]).rstrip(b"\0").decode()
+
+    @property
+    def heartbeat(self) -> float:
+        return HEADER.unpack_from(self.buf, 0)[5]
+
+    def beat(self) -> None:
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, len(self.names), self.pid, self.interval, monotonic())
+
+    def publish(self, sample: Sample) -> None:
+        """
+        Writer side, only the daemon calls this
+        """
+        offset = self.slots[sample.sensor]
+        seq = SEQ.unpack_from(self.buf, offset)[0]
+        SEQ.pack_into(self.buf, offset, seq + 1)
+        SLOT.pack_into(self.buf, offset + SEQ.size, sample.sensor.encode(), sample.frame, sample.timestamp,
+                       sample.monotonic, sample.crc_retries, sample.stale)
+        SEQ.pack_into(self.buf, offset, seq + 2)
+
+    def seq(self, sensor: str) -> int:
+        """
+        Changes every time the sensor's slot is written, 0 until the first sample
+        """
+        return SEQ.unpack_from(self.buf, self.slots[sensor])[0]
+
+    def read(self, sensor: str) -> Tuple[int, Sample | None]:
+        """
+        :return: the sequence number and the sample, None before the first one
+        :raises TornRead: if no consistent copy was made in `retries` attempts
+        """
+        offset = self.slots[sensor]
+        for _ in range(self.retries):
+            before = SEQ.unpack_from(self.buf, offset)[0]
+            if before & 1:
+                continue
+            _, frame, timestamp, mono, crc_retries, stale = SLOT.unpack_from(self.buf, offset + SEQ.size)
+            if SEQ.unpack_from(self.buf, offset)[0] != before:
+                continue
+            if before == 0:
+                return 0, None
+            if not frame_ok(frame):
+                continue
+            return before, Sample(sensor, frame, timestamp, mono, crc_retries, Record(frame), bool(stale))
+        raise TornRead(f"No consistent copy of the sample of sensor '{sensor}'")
+
+    def close(self) -> None:
+        # releases self.buf too, it is the segment's memoryview
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedSampler:
+    """
+    The `sampler.Sampler` interface of the API workers, served from a `SampleBoard`.
+    Only the daemon touches the bus, so `get` never reads the sensor: `max_age`, `read_count`
+    and `delay` are ignored, the sample is at most one daemon interval old. A sample is
+    flagged `stale` while the daemon's breaker is open and when the daemon has not swept
+    for `stale_after` intervals.
+    """
+    stale_after: float = 3
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, board: SampleBoard, name: str):
+        self.board = board
+        self.name = name
+        self.sample: Sample | None = None
+        self._seq = 0
+        self._listeners: List[Callable[[Sample], None]] = []
+
+    def subscribe(self, listener: Callable[[Sample], None]) -> None:
+        """
+        Called with every new sample, see `SharedSensors.poll_interval`
+        """
+        self._listeners.append(listener)
+
+    def _daemon_alive(self) -> bool:
+        return monotonic() - self.board.heartbeat <= self.stale_after * self.board.interval
+
+    def _current(self) -> Sample | None:
+        """
+        The latest sample, read from shared memory only when its slot has changed
+        """
+        if self.board.seq(self.name) != self._seq:
+            seq, sample = self.board.read(self.name)
+            previous, self._seq = self.sample, seq
+            if sample is not None and (previous is None or sample.monotonic > previous.monotonic
+                                       or sample.stale != previous.stale):
+                self.sample = sample
+                if previous is None or sample.monotonic > previous.monotonic:
+                    for listener in self._listeners:
+                        try:
+                            listener(sample)
+                        except Exception as e:
+                            self.log.error(f"Sample listener {listener!r} failed: {e!r}")
+        return self.sample
+
+    async def get(self, max_age: float = None, read_count: int = None, delay: int = None) -> Sample:
+        """
+        :raises IOError: if the daemon has not published a sample of this sensor yet
+        """
+        try:
+            sample = self._current()
+        except TornRead as e:
+            self.log.warning(str(e))
+            sample = self.sample
+        if sample is None:
+            raise IOError(f"No sample of sensor '{self.name}' from the sensor daemon yet")
+        if not sample.stale and not self._daemon_alive():
+            return sample._replace(stale=True)
+        return sample
+
+    async def refresh(self, read_count: int = None, delay: int = None, max_age: float = None) -> Sample:
+        return await self.get(max_age, read_count, delay)
+
+
+class SharedSensors:
+    """
+    Stands in for `sensors.SensorRegistry` in an API worker when the sensors are owned by
+    the sensor daemon: the same sensor names, default sensor and samplers, read from the
+    daemon's shared memory. start() polls the board every `poll_interval` seconds so
+    subscribers (streams, stats, recent samples) see every new sample.
+    """
+    poll_interval: float = 0.5
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, board: SampleBoard, poll_interval: float = None):
+        if poll_interval:
+            self.poll_interval = poll_interval
+        self.board = board
+        self.sensors: Dict[str, SharedSampler] = {name: SharedSampler(board, name) for name in board.names}
+        if not self.sensors:
+            raise ValueError("No sensors configured")
+        self.default: str = board.names[0]
+        self._task: Task | None = None
+
+    @classmethod
+    def attach(cls, name: str, poll_interval: float = None) -> "SharedSensors":
+        return cls(SampleBoard.attach(name), poll_interval)
+
+    def get(self, name: str | None = None) -> SharedSampler:
+        """
+        :raises KeyError: if there is no such sensor
+        """
+        return self.sensors[name or self.default]
+
+    @property
+    def samplers(self) -> List[SharedSampler]:
+        return list(self.sensors.values())
+
+    def subscribe(self, listener: Callable[[Sample], None]) -> None:
+        for s in self.samplers:
+            s.subscribe(listener)
+
+    async def _run(self) -> None:
+        while True:
+            for s in self.samplers:
+                try:
+                    s._current()
+                except TornRead as e:
+                    self.log.warning(str(e))
+            await sleep(self.poll_interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self.log.info(f"Reading {len(self.sensors)} sensors from the sensor daemon (pid {self.board.pid})")
+            self._task = create_task(self._run())
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.board.close()
@@ -0,0 +1,118 @@
+from errno import EIO, EREMOTEIO
+from logging import Logger, getLogger
+from random import Random
+from threading import Lock
+from time import monotonic, sleep
+from bases.I2CBusBase import I2CBusBase
+from crc import crc16
+
+
+class SimulatedAM2320Bus(I2CBusBase):
+    """
+    Software AM2320 behind a fake I2C bus, for running the driver without hardware.
+
+    Models the parts of the sensor the driver depends on:
+      - the sensor falls asleep after 3 s without bus traffic, the first write to a
+        sleeping sensor is not acknowledged (OSError) and wakes it up
+      - a read returns the measurement taken at the end of the previous read, so the
+        first read after wakeup returns stale data
+      - function 0x03 (read registers) with a correct Modbus CRC16
+      - optionally, timing: a request sent less than `min_wakeup` seconds after the
+        wakeup, or a read less than `min_settle` seconds after the request, is not
+        acknowledged. Both are 0 (no check) by default, `calibration.py` uses them.
+
+    Faults are injected with:
+      latency          seconds added to every write and read
+      crc_error_rate   probability of a corrupted byte in a response
+      bus_error_rate   probability of a write or read failing with EIO
+    """
+    SLEEP_AFTER: float = 3.0
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, humidity: float = 40.0, temperature: float = 21.5, noise: float = 0.2,
+                 latency: float = 0.0, crc_error_rate: float = 0.0, bus_error_rate: float = 0.0,
+                 seed: int = None, path: str = "sim", addr: int = 0x5c,
+                 min_wakeup: float = 0.0, min_settle: float = 0.0):
+        self.path = path
+        self.addr = addr
+        self.humidity = humidity
+        self.temperature = temperature
+        self.noise = noise
+        self.latency = latency
+        self.crc_error_rate = crc_error_rate
+        self.bus_error_rate = bus_error_rate
+        self.min_wakeup = min_wakeup
+        self.min_settle = min_settle
+        self.random = Random(seed)
+        self.writes = 0
+        self.reads = 0
+        self._lock = Lock()
+        self._awake_until = 0.0
+        self._woke_at = 0.0
+        self._requested_at = 0.0
+        self._request: bytes | None = None
+        self._registers = bytearray(self._measure())
+
+    def _measure(self) -> bytes:
+        humi = round((self.humidity + self.random.uniform(-self.noise, self.noise)) * 10)
+        temp = round((self.temperature + self.random.uniform(-self.noise, self.noise)) * 10)
+        temp = -temp | 0x8000 if temp < 0 else temp
+        return bytes([humi >> 8 & 0xff, humi & 0xff, temp >> 8 & 0xff, temp & 0xff])
+
+    def _fault(self) -> None:
+        if self.latency:
+            sleep(self.latency)
+        if self.bus_error_rate and self.random.random() < self.bus_error_rate:
+            raise OSError(EIO, "Simulated bus error")
+
+    def _awake(self) -> bool:
+        return monotonic() < self._awake_until
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def write(self, b: bytes) -> int:
+        with self._lock:
+            self._fault()
+            self.writes += 1
+            now = monotonic()
+            awake = self._awake()
+            self._awake_until = now + self.SLEEP_AFTER
+            if not awake:
+                self._request = None
+                self._woke_at = now
+                raise OSError(EREMOTEIO, "Remote I/O error")
+            if len(b) == 3 and b[0] == 0x03:
+                if now - self._woke_at < self.min_wakeup:
+                    # still booting
+                    self._request = None
+                    raise OSError(EREMOTEIO, "Remote I/O error")
+                self._request = bytes(b)
+                self._requested_at = now
+            return len(b)
+
+    def read(self, length: int) -> bytes:
+        with self._lock:
+            self._fault()
+            self.reads += 1
+            if not self._awake() or self._request is None:
+                raise OSError(EREMOTEIO, "Remote I/O error")
+            if monotonic() - self._requested_at < self.min_settle:
+                # still busy with the request, it has to be sent again
+                self._request = None
+                raise OSError(EREMOTEIO, "Remote I/O error")
+            self._awake_until = monotonic() + self.SLEEP_AFTER
+            _, start, num = self._request
+            self._request = None
+            regs = bytes(self._registers[start:start + num]).ljust(num, b'\x00')
+            body = bytes([0x03, num]) + regs
+            crc = crc16(body)
+            frame = bytearray(body + bytes([crc & 0xff, crc >> 8]))
+            if self.crc_error_rate and self.random.random() < self.crc_error_rate:
+                frame[self.random.randrange(2, len(frame))] ^= 1 << self.random.randrange(8)
+            # the sensor measures after a read, the next read returns this
+            self._registers[0:4] = self._measure()
+            return bytes(frame[:length])
@@ -1,13 +1,112 @@
 from sqlite3 import connect, Connection
 from datetime import datetime
+from threading import Lock, local
+from time import monotonic
+from typing import Dict, Iterable, List, Tuple
+
+# busy_timeout: wait for another worker's write instead of failing with "database is locked"
+PRAGMAS: Tuple[str, ...] = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA temp_store=MEMORY;"
+)
 
 
 def get_now():
     return datetime.utcnow().timestamp().__trunc__()
 
 
-def init_db(db_path: str):
-    db = connect(db_path)
+def open_db(db_path: str) -> Connection:
+    """
+    A connection with `PRAGMAS` applied. In WAL mode readers do not block the writer and
+    with synchronous=NORMAL a commit is an append to the WAL, only checkpoints fsync.
+    """
+    db = connect(db_path, check_same_thread=False, cached_statements=ConnectionPool.cached_statements)
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+
+class ConnectionPool:
+    """
+    One connection per thread, opened on first use from that thread and kept open, so the
+    statement cache of each connection stays warm: the SQL below is module constants, every
+    call after the first reuses the prepared statement.
+
+    Also caches `get_user` lookups for `user_ttl` seconds. Writes through this pool
+    invalidate the cache, the TTL bounds how long a write from another process goes unseen.
+    """
+    cached_statements: int = 64
+    user_ttl: float = 5
+    user_cache_size: int = 256
+
+    def __init__(self, db_path: str, user_ttl: float = None):
+        self.db_path = db_path
+        if user_ttl is not None:
+            self.user_ttl = user_ttl
+        self._local = local()
+        self._all: List[Connection] = []
+        self._lock = Lock()
+        self.users: Dict[str, Tuple[str, float]] = {}
+
+    def connection(self) -> Connection:
+        try:
+            return self._local.db
+        except AttributeError:
+            db = self._local.db = open_db(self.db_path)
+            with self._lock:
+                self._all.append(db)
+            return db
+
+    def close(self) -> None:
+        with self._lock:
+            connections, self._all = self._all, []
+        for db in connections:
+            db.close()
+        self._local = local()
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = Lock()
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """
+    The process-wide pool of `db_path`, so every user of a database shares its user cache
+    """
+    with _pools_lock:
+        if db_path not in _pools:
+            _pools[db_path] = ConnectionPool(db_path)
+        return _pools[db_path]
+
+
+def _connection(db: Connection | ConnectionPool) -> Connection:
+    return db.connection() if isinstance(db, ConnectionPool) else db
+
+
+SQL_GET_USER = 'SELECT "hash" FROM "users" WHERE "username" = ?;'
+SQL_ADD_USER = 'INSERT OR IGNORE INTO "users" ("username", "hash") VALUES (?, ?);'
+SQL_UPDATE_USER_HASH = 'UPDATE "users" SET "hash" = ? WHERE "username" = ?;'
+SQL_GET_TOKENS = 'SELECT "users"."username", "tokens"."expires", "tokens"."thumbprint" FROM "tokens" ' \
+                 'JOIN "users" ON "users"."id" = "tokens"."user_id" WHERE "tokens"."expires" > ?;'
+SQL_GET_TOKEN = 'SELECT "users"."username", "tokens"."expires" FROM "tokens" ' \
+                'JOIN "users" ON "users"."id" = "tokens"."user_id" WHERE "tokens"."thumbprint" = ?;'
+SQL_ISSUE_TOKEN = 'INSERT OR REPLACE INTO "tokens" ("user_id", "expires", "thumbprint") ' \
+                  'SELECT "id", ?, ? FROM "users" WHERE "username" = ?;'
+SQL_REVOKE_TOKEN = 'DELETE FROM "tokens" WHERE "thumbprint" = ?;'
+SQL_DELETE_EXPIRED_TOKENS = 'DELETE FROM "tokens" WHERE "expires" <= ?;'
+SQL_INSERT_READINGS = 'INSERT OR IGNORE INTO "readings" ' \
+                      '("sensor", "timestamp", "humidity", "temperature", "frame", "crc_retries") ' \
+                      'VALUES (?, ?, ?, ?, ?, ?);'
+SQL_GET_READINGS = 'SELECT "timestamp", "humidity", "temperature", "frame", "crc_retries" FROM "readings" ' \
+                   'WHERE "sensor" = ? AND "timestamp" >= ? AND "timestamp" > ? AND "timestamp" <= ? ' \
+                   'ORDER BY "timestamp" LIMIT ?;'
+
+
+def init_db(db_path: str) -> ConnectionPool:
+    pool = get_pool(db_path)
+    db = pool.connection()
     c = db.cursor()
     sql1 = """CREATE TABLE IF NOT EXISTS "users" (
         "id"            INTEGER     NOT NULL UNIQUE,
@@ -31,35 +130,122 @@ def init_db(db_path: str):
     c.close()
     db.commit()
 
-    return db
+    return pool
 
 
-def get_user(db: Connection, username: str) -> str:
-    c = db.cursor()
-    c.execute(f'SELECT "hash" FROM "users" WHERE "username" = ?;', [username])
+def get_user(db: Connection | ConnectionPool, username: str) -> str:
+    if isinstance(db, ConnectionPool):
+        now = monotonic()
+        cached = db.users.get(username)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+    c = _connection(db).execute(SQL_GET_USER, [username])
     r = c.fetchone()
-    if r and len(r) > 0:
-        return str(r[0])
-    return ""
+    encoded_hash = str(r[0]) if r and len(r) > 0 else ""
+    if isinstance(db, ConnectionPool):
+        if len(db.users) >= db.user_cache_size:
+            db.users.clear()
+        db.users[username] = (encoded_hash, now + db.user_ttl)
+    return encoded_hash
 
 
-# WIP
-def update_token(db: Connection, username: str, token_expiry: int, thumbprint: str):
-    c = db.cursor()
-    c.execute(f'SELECT "expires" FROM "tokens" WHERE "thumbprint = ?";', [thumbprint])
-    r = c.fetchone()
-    now = get_now()
-
-    if not r or now >= int(r[0]):
-        c.execute(f'SELECT "user_id" FROM "users" WHERE "username" = ?;', [username])
-        user_id = str(c.fetchone()[0])
-        c.execute(f'INSERT OR REPLACE INTO "tokens" ("user_id", "expires", "thumbprint") VALUES (?, ?, ?)',
-                  [user_id, token_expiry, thumbprint])
-    else:
-        c.execute(f'SELECT "expires" FROM "tokens" WHERE "user_id" = ?;')
-        r = c.fetchone()
-        if not r:
-            raise ValueError("Result set was empty when it should not be")
+def add_demo_user(db: Connection | ConnectionPool, username: str, encoded_hash: str) -> bool:
+    """
+    Adds a user unless one with that name exists
+    :return: True if the user was added
+    """
+    with _connection(db) as c:
+        added = c.execute(SQL_ADD_USER, [username, encoded_hash]).rowcount == 1
+    if isinstance(db, ConnectionPool):
+        db.users.pop(username, None)
+    return added
+
+
+def update_user_hash(db: Connection | ConnectionPool, username: str, encoded_hash: str) -> None:
+    with _connection(db) as c:
+        c.execute(SQL_UPDATE_USER_HASH, [encoded_hash, username])
+    if isinstance(db, ConnectionPool):
+        db.users.pop(username, None)
+
+
+def init_readings_db(db_path: str) -> Connection:
+    """
+    Opens (and creates if needed) the readings database, see `open_db`. The WAL appends
+    combined with batched inserts keep the SD card writes down.
+    The connection is meant to be used from one worker thread at a time.
+    """
+    db = open_db(db_path)
+    # The clustered primary key is the covering index on (sensor, timestamp): range scans
+    # for one sensor read the rows straight from the index b-tree, no rowid lookups.
+    db.execute("""CREATE TABLE IF NOT EXISTS "readings" (
+        "sensor"        TEXT        NOT NULL,
+        "timestamp"     REAL        NOT NULL,
+        "humidity"      REAL        NOT NULL,
+        "temperature"   REAL        NOT NULL,
+        "frame"         BLOB        NOT NULL,
+        "crc_retries"   INTEGER     NOT NULL DEFAULT 0,
+
+        PRIMARY KEY("sensor", "timestamp")
+    ) WITHOUT ROWID;""")
+    db.commit()
+
+    return db
+
+
+def insert_readings(db: Connection, rows: Iterable[Tuple[str, float, float, float, bytes, int]]) -> int:
+    """
+    Inserts a batch of readings in one transaction.
+    :param rows: (sensor, timestamp, humidity, temperature, frame, crc_retries) tuples
+    :return: number of rows inserted
+    """
+    with db:
+        c = db.executemany(SQL_INSERT_READINGS, rows)
+    return c.rowcount
+
+
+def get_readings(db: Connection, sensor: str, ts_from: float, ts_to: float,
+                 after: float | None = None, limit: int = 500) -> List[Tuple[float, float, float, bytes, int]]:
+    """
+    One page of readings for `sensor` with `ts_from <= timestamp <= ts_to`, oldest first.
+    Paging is keyset based: pass the last timestamp of the previous page as `after`.
+    :return: (timestamp, humidity, temperature, frame, crc_retries) tuples
+    """
+    c = db.execute(SQL_GET_READINGS,
+                   [sensor, ts_from, after if after is not None else float("-inf"), ts_to, limit])
+    return c.fetchall()
+
+
+def get_tokens(db: Connection | ConnectionPool, now: int) -> List[Tuple[str, int, str]]:
+    """
+    All tokens that have not expired at `now`
+    :return: (username, expires, thumbprint) tuples
+    """
+    return _connection(db).execute(SQL_GET_TOKENS, [now]).fetchall()
+
+
+def get_token(db: Connection | ConnectionPool, thumbprint: str) -> Tuple[str, int] | None:
+    """
+    :return: (username, expires) of the token, None if it is not in the table
+    """
+    return _connection(db).execute(SQL_GET_TOKEN, [thumbprint]).fetchone()
+
+
+def update_tokens(db: Connection | ConnectionPool, issued: Iterable[Tuple[str, int, str]],
+                  revoked: Iterable[str], now: int) -> None:
+    """
+    Writes a batch of token changes in one transaction and drops the expired rows.
+    "user_id" is unique, so an issued token replaces the user's previous one.
+    :param issued: (username, expires, thumbprint) tuples, in issuing order
+    :param revoked: thumbprints, applied after `issued`
+    """
+    with _connection(db) as c:
+        c.executemany(SQL_ISSUE_TOKEN, [(expires, thumbprint, username) for username, expires, thumbprint in issued])
+        c.executemany(SQL_REVOKE_TOKEN, [(t,) for t in revoked])
+        c.execute(SQL_DELETE_EXPIRED_TOKENS, [now])
+
+
+def update_token(db: Connection | ConnectionPool, username: str, token_expiry: int, thumbprint: str) -> None:
+    update_tokens(db, [(username, token_expiry, thumbprint)], [], get_now())
 
 # print(get_user(db, "demo_user"))
 
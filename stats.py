@@ -0,0 +1,122 @@
+from collections import deque
+from math import exp
+from time import monotonic
+from typing import Deque, Dict, List, Tuple
+from sampler import Sample
+from utils import fmt_data, handle_negative_temp
+
+# name -> seconds
+WINDOWS: Dict[str, float] = {"1m": 60, "1h": 3600, "24h": 86400}
+QUANTITIES: Tuple[str, ...] = ("humi", "temp")
+
+
+class Window:
+    """
+    Sliding time window over one quantity, amortized O(1) per sample:
+      - min and max from monotonic deques: a new value drops every older value it beats,
+        so the front of each deque is the extreme of the window
+      - mean and variance from running sums of the values and their squares
+      - EWMA with the window length as time constant, for uneven sample intervals
+    Values are the raw registers (tenths of a unit) so the sums are exact integers.
+    """
+    __slots__ = ("span", "values", "mins", "maxs", "total", "squares", "ewma", "_last")
+
+    def __init__(self, span: float):
+        self.span = span
+        self.values: Deque[Tuple[float, int]] = deque()
+        self.mins: Deque[Tuple[float, int]] = deque()
+        self.maxs: Deque[Tuple[float, int]] = deque()
+        self.total = 0
+        self.squares = 0
+        self.ewma: float | None = None
+        self._last = 0.0
+
+    def add(self, t: float, x: int) -> None:
+        self.values.append((t, x))
+        self.total += x
+        self.squares += x * x
+        mins, maxs = self.mins, self.maxs
+        while mins and mins[-1][1] >= x:
+            mins.pop()
+        mins.append((t, x))
+        while maxs and maxs[-1][1] <= x:
+            maxs.pop()
+        maxs.append((t, x))
+        if self.ewma is None:
+            self.ewma = float(x)
+        else:
+            alpha = 1 - exp(-(t - self._last) / self.span)
+            self.ewma += alpha * (x - self.ewma)
+        self._last = t
+        self.expire(t)
+
+    def expire(self, now: float) -> None:
+        cutoff = now - self.span
+        values = self.values
+        while values and values[0][0] <= cutoff:
+            _, x = values.popleft()
+            self.total -= x
+            self.squares -= x * x
+        while self.mins and self.mins[0][0] <= cutoff:
+            self.mins.popleft()
+        while self.maxs and self.maxs[0][0] <= cutoff:
+            self.maxs.popleft()
+
+    def summary(self, now: float) -> dict:
+        self.expire(now)
+        n = len(self.values)
+        if not n:
+            return {"count": 0, "min": None, "max": None, "mean": None, "variance": None, "ewma": None}
+        mean = self.total / n
+        return {
+            "count": n,
+            "min": self.mins[0][1] / 10,
+            "max": self.maxs[0][1] / 10,
+            "mean": mean / 10,
+            # population variance, in units squared
+            "variance": max(self.squares / n - mean * mean, 0.0) / 100,
+            "ewma": self.ewma / 10 if self.ewma is not None else None
+        }
+
+
+class Stats:
+    """
+    Rolling statistics per sensor, quantity and window, updated by every new sample.
+    Register `record` as a sampler listener, `summary` never touches the sensor or the database.
+    """
+
+    def __init__(self, windows: Dict[str, float] = None):
+        self.windows = windows or WINDOWS
+        self._series: Dict[str, Dict[str, List[Window]]] = {}
+
+    def record(self, sample: Sample) -> None:
+        """
+        Sampler listener
+        """
+        series = self._series.get(sample.sensor)
+        if series is None:
+            series = self._series[sample.sensor] = {
+                q: [Window(span) for span in self.windows.values()] for q in QUANTITIES}
+        frame = sample.frame
+        values = (fmt_data(frame, 2, 3), handle_negative_temp(fmt_data(frame, 4, 5)))
+        for q, x in zip(QUANTITIES, values):
+            for w in series[q]:
+                w.add(sample.monotonic, x)
+
+    @property
+    def sensors(self) -> List[str]:
+        return list(self._series)
+
+    def summary(self, sensor: str, window: str | None = None) -> dict:
+        """
+        {"humi": {"1m": {"count", "min", "max", "mean", "variance", "ewma"}, ...}, "temp": {...}}
+        :param window: only this window
+        :raises KeyError: for an unknown window, or a sensor without samples
+        """
+        if window is not None and window not in self.windows:
+            raise KeyError(window)
+        series = self._series[sensor]
+        names = list(self.windows)
+        now = monotonic()
+        return {q: {name: w.summary(now) for name, w in zip(names, windows) if window in (None, name)}
+                for q, windows in series.items()}
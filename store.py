@@ -0,0 +1,146 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from time import monotonic, time
+from typing import Dict, Iterator, List, Tuple
+from sampler import Sample
+from utils import fmt_data, handle_negative_temp
+
+
+class SampleSlice:
+    """
+    A run of consecutive samples in a `SampleStore`, as one or two zero-copy memoryview
+    segments per column (two when the run wraps around the end of the ring).
+
+    The views point into the store: a slice is only valid until the samples it covers are
+    overwritten, read it right away (within the same event loop step).
+    """
+    __slots__ = ("times", "humi", "temp")
+
+    def __init__(self, times: Tuple[memoryview, ...], humi: Tuple[memoryview, ...], temp: Tuple[memoryview, ...]):
+        self.times = times
+        self.humi = humi
+        self.temp = temp
+
+    def __len__(self) -> int:
+        return sum(len(t) for t in self.times)
+
+    def __iter__(self) -> Iterator[Tuple[float, int, int]]:
+        """
+        (monotonic time, humidity register, temperature register), oldest first
+        """
+        for times, humi, temp in zip(self.times, self.humi, self.temp):
+            yield from zip(times, humi, temp)
+
+    def columns(self, offset: float = None) -> Dict[str, List[float]]:
+        """
+        Decoded columns: unix timestamps, humidity in % and temperature in °C
+        :param offset: unix time minus monotonic time, the current one by default
+        """
+        if offset is None:
+            offset = time() - monotonic()
+        return {
+            "timestamps": [t + offset for seg in self.times for t in seg],
+            "humi": [x / 10 for seg in self.humi for x in seg],
+            "temp": [x / 10 for seg in self.temp for x in seg]
+        }
+
+
+class SampleStore:
+    """
+    Ring buffer of the last `capacity` samples of one sensor in preallocated array columns:
+    the humidity and temperature registers as array('h') (decoded like
+    `utils.fmt_data`/`handle_negative_temp`, tenths of a unit) and the monotonic time of
+    each sample as array('d'). That is 12 bytes per sample, a week of 1 Hz samples takes 7 MB.
+
+    Only monotonic time is stored, unix time is derived when reading. Without an RTC the
+    wall clock of a Pi can jump at boot when NTP syncs, monotonic time does not.
+    Times are non-decreasing, so windows are found by binary search.
+    """
+    capacity: int = 60480   # a week at the default 10 s interval
+
+    def __init__(self, capacity: int = None):
+        if capacity:
+            self.capacity = capacity
+        self.times = array("d", bytes(8 * self.capacity))
+        self.humi = array("h", bytes(2 * self.capacity))
+        self.temp = array("h", bytes(2 * self.capacity))
+        self.start = 0      # physical index of the oldest sample
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def arrays(self) -> Tuple[array, array, array]:
+        return self.times, self.humi, self.temp
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.itemsize * len(a) for a in self.arrays)
+
+    def append(self, t: float, humi: int, temp: int) -> None:
+        if self.size and t < self.times[(self.start + self.size - 1) % self.capacity]:
+            raise ValueError("Samples must be appended in time order")
+        i = (self.start + self.size) % self.capacity
+        self.times[i] = t
+        self.humi[i] = humi
+        self.temp[i] = temp
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.size += 1
+
+    def add(self, sample: Sample) -> None:
+        """
+        Sampler listener
+        """
+        frame = sample.frame
+        self.append(sample.monotonic, fmt_data(frame, 2, 3), handle_negative_temp(fmt_data(frame, 4, 5)))
+
+    def _bisect(self, t: float, right: bool = False) -> int:
+        """
+        Logical index (0 = oldest) of the first sample at or after `t`, or after `t` if `right`
+        """
+        search = bisect_right if right else bisect_left
+        start, end, cap = self.start, self.start + self.size, self.capacity
+        if end <= cap:
+            return search(self.times, t, start, end) - start
+        # wrapped: [start, cap) holds the older part, [0, end - cap) the newer
+        last_old = self.times[cap - 1]
+        if last_old > t or (not right and last_old == t):
+            return search(self.times, t, start, cap) - start
+        return cap - start + search(self.times, t, 0, end - cap)
+
+    def _slice(self, first: int, last: int) -> SampleSlice:
+        """
+        Logical indexes [first, last)
+        """
+        cap = self.capacity
+        a, b = self.start + first, self.start + last
+        if b <= cap:
+            ranges = [(a, b)]
+        elif a >= cap:
+            ranges = [(a - cap, b - cap)]
+        else:
+            ranges = [(a, cap), (0, b - cap)]
+        views = [memoryview(col) for col in self.arrays]
+        times, humi, temp = (tuple(v[i:j] for i, j in ranges) for v in views)
+        return SampleSlice(times, humi, temp)
+
+    def last(self, n: int) -> SampleSlice:
+        n = max(min(n, self.size), 0)
+        return self._slice(self.size - n, self.size)
+
+    def between(self, t_from: float, t_to: float) -> SampleSlice:
+        """
+        Samples with `t_from <= monotonic time <= t_to`
+        """
+        first = self._bisect(t_from)
+        last = self._bisect(t_to, right=True)
+        return self._slice(first, max(first, last))
+
+    def since(self, seconds: float) -> SampleSlice:
+        """
+        Samples from the last `seconds` seconds
+        """
+        return self.between(monotonic() - seconds, float("inf"))
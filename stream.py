@@ -0,0 +1,83 @@
+from asyncio import Queue, QueueEmpty, QueueFull
+from json import dumps
+from logging import Logger, getLogger
+from typing import Set
+from sampler import Sample
+from utils import Record
+
+
+class Event:
+    """
+    One sample, serialized once for every subscriber and transport
+    """
+    __slots__ = ("sensor", "json", "sse")
+
+    def __init__(self, sample: Sample):
+        record = sample.record or Record(sample.frame)
+        self.sensor = sample.sensor
+        self.json: str = dumps({"sensor": sample.sensor, "timestamp": sample.timestamp,
+                                "humi": record.humi, "temp": record.temp}, separators=(",", ":"))
+        self.sse: bytes = f"event: sample\ndata: {self.json}\n\n".encode()
+
+
+class Subscription:
+    """
+    Bounded per-client queue. When the client falls behind, the oldest pending
+    event is dropped to make room for the new one.
+    """
+    dropped: int = 0
+
+    def __init__(self, maxsize: int, sensor: str | None = None):
+        self.queue: Queue[Event] = Queue(maxsize)
+        self.sensor = sensor
+
+    def put(self, event: Event) -> None:
+        if self.sensor is not None and event.sensor != self.sensor:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except QueueFull:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except QueueEmpty:
+                pass
+            self.queue.put_nowait(event)
+
+    async def get(self) -> Event:
+        return await self.queue.get()
+
+
+class Broadcaster:
+    """
+    Fans every new sample out to the WebSocket and SSE subscribers. The sample is
+    serialized once no matter how many clients are listening.
+    """
+    queue_size: int = 16
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, queue_size: int = None):
+        if queue_size:
+            self.queue_size = queue_size
+        self.subscriptions: Set[Subscription] = set()
+
+    def subscribe(self, sensor: str | None = None) -> Subscription:
+        s = Subscription(self.queue_size, sensor)
+        self.subscriptions.add(s)
+        self.log.debug(f"Stream subscriber added, {len(self.subscriptions)} total")
+        return s
+
+    def unsubscribe(self, s: Subscription) -> None:
+        self.subscriptions.discard(s)
+        if s.dropped:
+            self.log.info(f"Slow stream subscriber dropped {s.dropped} events")
+
+    def publish(self, sample: Sample) -> None:
+        """
+        Sampler listener
+        """
+        if not self.subscriptions:
+            return
+        event = Event(sample)
+        for s in self.subscriptions:
+            s.put(event)
@@ -0,0 +1,41 @@
+import sys
+import unittest
+from os import path
+from random import Random
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from crc import crc16, crc16_bitwise, crc16_many, frame_ok  # noqa: E402
+
+# frames as read from an AM2320: function code, byte count, registers, CRC low byte first
+FRAMES = [
+    bytes.fromhex("0304018d00f2e1ba"),     # 39.7 %, 24.2 °C
+    bytes.fromhex("030401f400fa31a5"),     # 50.0 %, 25.0 °C, the datasheet example
+]
+
+
+class CRC16Test(unittest.TestCase):
+    def test_known_frames(self):
+        for frame in FRAMES:
+            expected = frame[-1] << 8 | frame[-2]
+            self.assertEqual(crc16_bitwise(frame[:-2]), expected)
+            self.assertEqual(crc16(frame[:-2]), expected)
+            self.assertTrue(frame_ok(frame))
+        self.assertEqual(crc16_many(FRAMES), [True, True])
+
+    def test_corrupted_frames(self):
+        for frame in FRAMES:
+            corrupted = frame[:2] + bytes([frame[2] ^ 0x01]) + frame[3:]
+            self.assertFalse(frame_ok(corrupted))
+        self.assertEqual(crc16_many([FRAMES[0][:-1] + b"\x00", b"\x03\x04"]), [False, False])
+
+    def test_table_agrees_with_bitwise(self):
+        rng = Random(4)
+        for n in [0, 1, 2, 6, 64, 257]:
+            for _ in range(50):
+                data = bytes(rng.getrandbits(8) for _ in range(n))
+                self.assertEqual(crc16(data), crc16_bitwise(data), data.hex())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import sys
+import unittest
+from asyncio import Event, run, sleep, wait_for
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from starlette.applications import Starlette  # noqa: E402
+from starlette.responses import PlainTextResponse, StreamingResponse  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+from main import uncompressed  # noqa: E402
+from middleware import SecurityMiddleware, SelectiveGZipMiddleware  # noqa: E402
+
+EVENT = b"event: sample\ndata: {}\n\n"
+
+
+async def stream(request):
+    async def events():
+        yield EVENT
+        await Event().wait()    # an idle stream, like SSE between samples
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def text(request):
+    return PlainTextResponse("x" * 1000)
+
+
+APP = SelectiveGZipMiddleware(Starlette(routes=[Route("/api/stream", stream), Route("/text", text)]),
+                              skip=uncompressed)
+
+
+async def request(path: str, timeout: float = 1) -> list:
+    """
+    The messages the app sends within `timeout` seconds, with Accept-Encoding: gzip
+    """
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"host", b"test"), (b"accept-encoding", b"gzip")],
+             "client": ("127.0.0.1", 1), "server": ("test", 80)}
+    messages = []
+
+    async def receive():
+        await sleep(3600)
+
+    async def send(message):
+        messages.append(message)
+
+    try:
+        await wait_for(APP(scope, receive, send), timeout)
+    except TimeoutError:
+        pass
+    return messages
+
+
+class SelectiveGZipTest(unittest.TestCase):
+    def test_event_stream_is_not_buffered(self):
+        messages = run(request("/api/stream"))
+        headers = dict(messages[0]["headers"])
+        self.assertNotIn(b"content-encoding", headers)
+        self.assertEqual(messages[1]["body"], EVENT)
+
+    def test_other_responses_are_compressed(self):
+        messages = run(request("/text"))
+        self.assertEqual(dict(messages[0]["headers"])[b"content-encoding"], b"gzip")
+
+
+class SecurityWebSocketTest(unittest.TestCase):
+    PROXY = [(b"x-nginx-proxy", b"true"), (b"x-real-ip", b"10.0.0.1"), (b"x-forwarded-for", b"10.0.0.1")]
+
+    def connect(self, headers: list) -> list:
+        """
+        The messages sent on a WebSocket connect, the app accepts every connection
+        """
+        async def app(scope, receive, send):
+            await send({"type": "websocket.accept"})
+
+        async def receive():
+            return {"type": "websocket.connect"}
+
+        messages: list = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "websocket", "path": "/api/stream", "query_string": b"", "headers": headers}
+        run(SecurityMiddleware(app)(scope, receive, send))
+        return messages
+
+    def test_unproxied_websocket_is_closed(self):
+        self.assertEqual(self.connect([]), [{"type": "websocket.close", "code": 1008}])
+        self.assertEqual(self.connect(self.PROXY[:2] + [(b"x-forwarded-for", b"10.0.0.2")]), [{"type": "websocket.close", "code": 1008}])
+
+    def test_proxied_websocket_reaches_the_app(self):
+        self.assertEqual(self.connect(self.PROXY), [{"type": "websocket.accept"}])
+
+
+class UncompressedTest(unittest.TestCase):
+    def test_paths(self):
+        def scope(path: str, query: bytes = b"") -> dict:
+            return {"path": path, "query_string": query}
+        self.assertTrue(uncompressed(scope("/api/stream")))
+        self.assertTrue(uncompressed(scope("/api/export", b"format=csv&compress=gzip")))
+        self.assertFalse(uncompressed(scope("/api/export", b"format=csv")))
+        self.assertFalse(uncompressed(scope("/api/getData", b"compress=gzip")))
+
+
+if __name__ == "__main__":
+    unittest.main()
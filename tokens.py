@@ -0,0 +1,203 @@
+from asyncio import Task, CancelledError, create_task, get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from heapq import heappop, heappush
+from logging import Logger, getLogger
+from time import monotonic
+from typing import Dict, List, Tuple
+from sqlite import ConnectionPool, get_now, get_pool, get_token, get_tokens, update_tokens
+
+
+def thumbprint(token_string: str) -> str:
+    """
+    Identifies a token in the registry and in the "tokens" table
+    """
+    return sha256(token_string.encode()).hexdigest()
+
+
+class TokenRegistry:
+    """
+    The live token of every user, kept in memory so a request is checked with a dict
+    lookup instead of a query. Issuing a token revokes the user's previous one.
+
+    Issuance and revocation are queued and written to the "tokens" table in batches on
+    a single worker thread, every `flush_interval` seconds or when `batch_size` changes
+    are pending. Expired tokens are swept from an expiry heap a few at a time on every
+    check and issue. start() rebuilds the registry from the table.
+
+    The registry is per process. With several workers (see daemon.py) pass `shared`: the
+    routes then write every change through with flush(), a token this worker has not seen
+    is looked up in the table on the worker thread (and a miss is remembered for
+    `flush_interval` seconds), and the registry is rebuilt from the table every
+    `flush_interval` seconds, which is how long a revocation by another worker goes unseen.
+    """
+    batch_size: int = 32
+    flush_interval: float = 5
+    sweep_limit: int = 8
+    unknown_size: int = 1024
+    log: Logger = getLogger(__name__)
+
+    def __init__(self, db_path: str, batch_size: int = None, flush_interval: float = None,
+                 shared: bool = False):
+        if batch_size:
+            self.batch_size = batch_size
+        if flush_interval:
+            self.flush_interval = flush_interval
+        self.db_path = db_path
+        self.shared = shared
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokens")
+        self.db: ConnectionPool | None = None
+        self._live: Dict[str, Tuple[str, int]] = {}     # thumbprint -> (username, expires)
+        self._by_user: Dict[str, str] = {}              # username -> thumbprint
+        self._expiry: List[Tuple[int, str]] = []        # (expires, thumbprint), may hold revoked ones
+        self._issued: List[Tuple[str, int, str]] = []
+        self._revoked: List[str] = []
+        self._unknown: Dict[str, float] = {}            # thumbprint -> monotonic time the miss expires
+        self._changed: set[str] | None = None           # users issued or revoked during a reload
+        self._task: Task | None = None
+        self._flushes: set[Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    async def _run_db(self, fn, *args):
+        return await get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def start(self) -> None:
+        # the worker thread gets its own connection from the pool
+        self.db = get_pool(self.db_path)
+        await self._reload()
+        self.log.info(f"Loaded {len(self._live)} live tokens")
+        self._task = create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        self.executor.shutdown()
+
+    async def _run(self) -> None:
+        while True:
+            await sleep(self.flush_interval)
+            await self.flush()
+            if self.shared:
+                await self._reload()
+
+    async def _reload(self) -> None:
+        self._changed = set()
+        try:
+            rows = await self._run_db(get_tokens, self.db, get_now())
+        finally:
+            changed, self._changed = self._changed, None
+        # the snapshot may predate a revocation or re-login made while it was read, the
+        # current entries of those users win over their rows
+        kept = [(username, self._live[tp][1], tp) for username, tp in self._by_user.items()
+                if username in changed and tp in self._live]
+        self._live, self._by_user, self._expiry = {}, {}, []
+        for username, expires, tp in rows:
+            if username not in changed:
+                self._add(username, expires, tp)
+        for username, expires, tp in kept:
+            self._add(username, expires, tp)
+        # changes made while the table was read, not written yet
+        for username, expires, tp in self._issued:
+            self._add(username, expires, tp)
+        for tp in self._revoked:
+            self._remove(tp)
+
+    def _add(self, username: str, expires: int, tp: str) -> None:
+        old = self._by_user.get(username)
+        if old is not None:
+            self._live.pop(old, None)
+        self._live[tp] = (username, expires)
+        self._by_user[username] = tp
+        heappush(self._expiry, (expires, tp))
+
+    def _remove(self, tp: str) -> None:
+        entry = self._live.pop(tp, None)
+        if entry is not None and self._by_user.get(entry[0]) == tp:
+            del self._by_user[entry[0]]
+
+    def _sweep(self, now: int) -> None:
+        heap = self._expiry
+        for _ in range(self.sweep_limit):
+            if not heap or heap[0][0] > now:
+                return
+            _, tp = heappop(heap)
+            self._remove(tp)
+
+    def _queued(self) -> None:
+        if len(self._issued) + len(self._revoked) >= self.batch_size:
+            t = create_task(self.flush())
+            self._flushes.add(t)
+            t.add_done_callback(self._flushes.discard)
+
+    def issue(self, username: str, token_string: str, expires: int) -> None:
+        """
+        Register a newly signed token as the user's only live token
+        """
+        self._sweep(get_now())
+        tp = thumbprint(token_string)
+        self._add(username, expires, tp)
+        self._issued.append((username, expires, tp))
+        if self._changed is not None:
+            self._changed.add(username)
+        self._queued()
+
+    def revoke(self, token_string: str) -> bool:
+        """
+        :return: False if the token was not live
+        """
+        tp = thumbprint(token_string)
+        entry = self._live.get(tp)
+        if entry is None:
+            return False
+        self._remove(tp)
+        self._revoked.append(tp)
+        if self._changed is not None:
+            self._changed.add(entry[0])
+        self._queued()
+        return True
+
+    async def is_live(self, token_string: str, now: int = None) -> bool:
+        now = now or get_now()
+        self._sweep(now)
+        tp = thumbprint(token_string)
+        entry = self._live.get(tp)
+        if entry is None and self.shared and self.db is not None:
+            entry = await self._lookup(tp, now)
+        return entry is not None and entry[1] > now
+
+    async def _lookup(self, tp: str, now: int) -> Tuple[str, int] | None:
+        """
+        A token another worker may have issued since the last reload
+        """
+        if self._unknown.get(tp, 0) > monotonic():
+            return None
+        entry = await self._run_db(get_token, self.db, tp)
+        if entry is not None and entry[1] > now:
+            self._add(entry[0], entry[1], tp)
+            return entry
+        if len(self._unknown) >= self.unknown_size:
+            self._unknown.clear()
+        self._unknown[tp] = monotonic() + self.flush_interval
+        return None
+
+    async def flush(self) -> None:
+        if (not self._issued and not self._revoked) or self.db is None:
+            return
+        issued, revoked = self._issued, self._revoked
+        self._issued, self._revoked = [], []
+        try:
+            await self._run_db(update_tokens, self.db, issued, revoked, get_now())
+            self.log.debug(f"Wrote {len(issued)} issued and {len(revoked)} revoked tokens")
+        except Exception as e:
+            # keep the changes for the next attempt, in order
+            self.log.error(f"Writing {len(issued) + len(revoked)} token changes failed: {e!r}")
+            self._issued[:0] = issued
+            self._revoked[:0] = revoked
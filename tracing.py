@@ -0,0 +1,159 @@
+from collections import deque
+from time import perf_counter, time
+from typing import Deque, List, NamedTuple, Tuple
+
+PHASES: Tuple[str, ...] = ("wakeup", "wakeup_sleep", "request", "request_sleep", "read", "crc")
+
+
+class Attempt(NamedTuple):
+    """
+    Durations in seconds of one wakeup/request/read cycle, in the order of `PHASES`
+    """
+    wakeup: float
+    wakeup_sleep: float
+    request: float
+    request_sleep: float
+    read: float
+    crc: float
+    crc_ok: bool
+
+
+class ReadTrace(NamedTuple):
+    bus: str
+    start: int              # first register
+    num: int                # number of registers
+    timestamp: float        # unix time when the read started
+    bus_wait: float         # seconds spent waiting for the bus lock
+    total: float            # seconds from getting the bus to the end of the last attempt
+    attempts: Tuple[Attempt, ...]
+    error: str | None = None
+
+    @property
+    def retries(self) -> int:
+        return max(len(self.attempts) - 1, 0)
+
+    def as_dict(self) -> dict:
+        return {
+            "bus": self.bus,
+            "start": self.start,
+            "num": self.num,
+            "timestamp": self.timestamp,
+            "bus_wait": self.bus_wait,
+            "total": self.total,
+            "retries": self.retries,
+            "error": self.error,
+            "attempts": [a._asdict() for a in self.attempts]
+        }
+
+
+class PhaseTimer:
+    """
+    Collects the phase durations of one attempt:
+        t = PhaseTimer(); ...; t.lap("wakeup"); ...; t.lap("wakeup_sleep") ...
+    """
+    __slots__ = ("_last", "laps")
+
+    def __init__(self):
+        self._last = perf_counter()
+        self.laps: dict = {}
+
+    def lap(self, phase: str) -> None:
+        now = perf_counter()
+        self.laps[phase] = now - self._last
+        self._last = now
+
+    def attempt(self, crc_ok: bool) -> Attempt:
+        return Attempt._make([*(self.laps.get(p, 0.0) for p in PHASES), crc_ok])
+
+
+class TraceBuilder:
+    """
+    Builds a `ReadTrace` while a read is in progress
+    """
+    __slots__ = ("bus", "start", "num", "timestamp", "_waiting", "_started", "bus_wait", "attempts")
+
+    def __init__(self, bus: str, start: int, num: int):
+        self.bus = bus
+        self.start = start
+        self.num = num
+        self.timestamp = time()
+        self._waiting = self._started = perf_counter()
+        self.bus_wait = 0.0
+        self.attempts: List[Attempt] = []
+
+    def got_bus(self) -> None:
+        self._started = perf_counter()
+        self.bus_wait = self._started - self._waiting
+
+    def build(self, error: str | None = None) -> ReadTrace:
+        return ReadTrace(self.bus, self.start, self.num, self.timestamp, self.bus_wait,
+                         perf_counter() - self._started, tuple(self.attempts), error)
+
+
+class TraceRecorder:
+    """
+    Trace hook that keeps the last `size` traces in a ring buffer.
+    deque.append is atomic, so it can be fed from the bus worker threads.
+    """
+    size: int = 100
+
+    def __init__(self, size: int = None):
+        if size:
+            self.size = size
+        self.traces: Deque[ReadTrace] = deque(maxlen=self.size)
+
+    def __call__(self, trace: ReadTrace) -> None:
+        self.traces.append(trace)
+
+    def dump(self, limit: int = None) -> List[dict]:
+        traces = list(self.traces)
+        if limit:
+            traces = traces[-limit:]
+        return [t.as_dict() for t in traces]
+
+    def summary(self) -> dict:
+        """
+        Mean duration per phase (first attempt of each read), bus wait and retries
+        """
+        traces = list(self.traces)
+        firsts = [t.attempts[0] for t in traces if t.attempts]
+        n = len(firsts)
+        return {
+            "traces": len(traces),
+            "mean": {p: sum(getattr(a, p) for a in firsts) / n for p in PHASES} if n else {},
+            "mean_bus_wait": sum(t.bus_wait for t in traces) / len(traces) if traces else 0.0,
+            "mean_total": sum(t.total for t in traces) / len(traces) if traces else 0.0,
+            "retries": sum(t.retries for t in traces),
+            "errors": sum(1 for t in traces if t.error)
+        }
+
+
+if __name__ == "__main__":
+    # python tracing.py [--sim] [--bus /dev/i2c-1] [--reads N] [--delay S]
+    # reads the sensor N times and prints one JSON trace per line, then the summary
+    from argparse import ArgumentParser
+    from json import dumps
+    from time import sleep
+    from AM2320 import AM2320
+    from simulator import SimulatedAM2320Bus
+
+    parser = ArgumentParser(description="Trace AM2320 reads")
+    parser.add_argument("--sim", action="store_true", help="use the simulated sensor")
+    parser.add_argument("--bus", default=AM2320.I2C_BUS)
+    parser.add_argument("--reads", type=int, default=5)
+    parser.add_argument("--delay", type=float, default=2)
+    args = parser.parse_args()
+
+    recorder = TraceRecorder(args.reads)
+    dev = AM2320(bus=args.bus, loglevel="WARN", i2c=SimulatedAM2320Bus() if args.sim else None)
+    dev.add_trace_hook(recorder)
+    for i in range(args.reads):
+        try:
+            dev._read_registers(0x00, 0x04)
+        except OSError as e:
+            print(f"read #{i + 1} failed: {e!r}")
+        if i < args.reads - 1:
+            sleep(args.delay)
+    for t in recorder.dump():
+        print(dumps(t))
+    print(dumps(recorder.summary(), indent=2))
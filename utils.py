@@ -1,4 +1,49 @@
 from base64 import b64encode
+from json import dumps
+from os import environ
+from typing import Dict, Tuple
+from crc import crc16
+
+# the `q` and `format` values of fmt_response
+QUANTITIES: Tuple[str, ...] = ("all", "humi", "temp")
+DATA_FORMATS: Tuple[str, ...] = ("json", "hex", "base64", "human")
+
+
+def env_flag(name: str) -> bool:
+    return environ.get(name, "").lower() in ("1", "true", "yes")
+
+
+def handle_negative_temp(temperature: int) -> int:
+    """
+    Temperature register is 16 bits long and the 16th bit is there to tell if we're below zero
+    """
+    if temperature & 0x8000:
+        return -(temperature & 0x7fff)
+    else:
+        return temperature
+
+
+def fmt_data(d: bytes, hi: int, lo: int) -> int:
+    return d[hi] << 8 | d[lo]
+
+
+def sub_frame(frame: bytes, cmd: str) -> bytes:
+    """
+    Cuts the registers asked for by `cmd` out of a full `get_all()` frame and wraps them into
+    a frame identical to what `get_humidity()` or `get_temperature()` would have returned.
+    :param frame: Full frame: [0x03, 0x04, humi_hi, humi_lo, temp_hi, temp_lo, crc_lo, crc_hi]
+    :param cmd: The command (all, humi, temp)
+    :return: Frame with a recomputed CRC
+    """
+    match cmd:
+        case "humi":
+            body = bytes([0x03, 0x02]) + frame[2:4]
+        case "temp":
+            body = bytes([0x03, 0x02]) + frame[4:6]
+        case _:
+            return frame
+    crc = crc16(body)
+    return body + bytes([crc & 0xff, crc >> 8])
 
 
 def fmt_response(cmd: str, data: bytes, fmt: str | None = "human", enc: str = "utf8") -> str | dict[str, float]:
@@ -11,18 +56,6 @@ def fmt_response(cmd: str, data: bytes, fmt: str | None = "human", enc: str = "u
     :return: Formatted sensor data as bytes.
     """
 
-    def handle_negative_temp(temperature: int) -> int:
-        """
-        Temperature register is 16 bits long and the 16th bit is there to tell if we're below zero
-        """
-        if temperature & 0x8000:
-            return -(temperature & 0x7fff)
-        else:
-            return temperature
-
-    def fmt_data(d: bytes, hi: int, lo: int) -> int:
-        return d[hi] << 8 | d[lo]
-
     match cmd:
         case "all":
             match fmt:
@@ -75,3 +108,51 @@ def fmt_response(cmd: str, data: bytes, fmt: str | None = "human", enc: str = "u
         case _:
             return b'\x00'.decode(enc)
     return b'\x00'.decode(enc)
+
+
+class Record:
+    """
+    A validated `get_all()` frame, decoded once. Sub-frames and `fmt_response` renderings
+    are produced on first use and kept, so every (q, format) pair is formatted at most
+    once per sample however many requests ask for it.
+    """
+    __slots__ = ("frame", "humi", "temp", "_frames", "_rendered")
+
+    def __init__(self, frame: bytes):
+        self.frame = frame
+        self.humi: float = fmt_data(frame, 2, 3) / 10
+        self.temp: float = handle_negative_temp(fmt_data(frame, 4, 5)) / 10
+        self._frames: Dict[str, bytes] = {}
+        self._rendered: Dict[tuple, str | dict[str, float] | bytes] = {}
+
+    def sub_frame(self, cmd: str) -> bytes:
+        f = self._frames.get(cmd)
+        if f is None:
+            f = self._frames[cmd] = sub_frame(self.frame, cmd)
+        return f
+
+    def render(self, cmd: str, fmt: str | None) -> str | dict[str, float]:
+        """
+        Same as `fmt_response(cmd, sub_frame(frame, cmd), fmt)`, memoized for the values in
+        `QUANTITIES` and `DATA_FORMATS`, so a record holds at most 12 renderings.
+        Do not modify the returned dict.
+        """
+        if cmd not in QUANTITIES or fmt not in DATA_FORMATS:
+            return fmt_response(cmd, sub_frame(self.frame, cmd), fmt)
+        key = (cmd, fmt)
+        r = self._rendered.get(key)
+        if r is None:
+            r = self._rendered[key] = fmt_response(cmd, self.sub_frame(cmd), fmt)
+        return r  # type: ignore
+
+    def response(self, key: Tuple, content: dict) -> bytes:
+        """
+        JSON body for `content`, encoded the way starlette's JSONResponse would and memoized
+        under `key`, which must cover everything `content` depends on. Only pass keys made of
+        validated values, every distinct key stays in memory as long as the record.
+        """
+        body = self._rendered.get(key)
+        if body is None:
+            body = self._rendered[key] = dumps(content, ensure_ascii=False, allow_nan=False, indent=None,
+                                               separators=(",", ":")).encode("utf-8")
+        return body  # type: ignore